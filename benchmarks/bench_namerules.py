@@ -0,0 +1,53 @@
+# python -m benchmarks.bench_namerules [--count 100000] [--rounds 3]
+from os.path import join
+
+import click
+
+from benchmarks.trees import measure, synthetic_paths
+from kudu.commands.push import get_name_rules
+from kudu.namerules import NameMapper, NameRule
+
+# the rules as they were matched one after another before first-match
+LEGACY_RULES = [
+    NameRule(r"^thumbnail.png", "{base_name}.png"),
+    NameRule(r"(.+)", ("{base_name}", "{0}")),
+]
+
+
+def legacy_map(rules, base_name, name):
+    for rule in rules:
+        m = rule.pattern.match(name)
+        if m:
+            name = rule.path.format(*m.groups(), base_name=base_name)
+    return name
+
+
+DIRS = ["", "css", "js", join("media", "video"), join("slides", "a", "b", "c")]
+
+
+@click.command()
+@click.option("--count", type=int, default=100000, help="Number of paths")
+@click.option("--rounds", type=int, default=3)
+def main(count, rounds):
+    paths = synthetic_paths(count, DIRS)
+    mapper = NameMapper(get_name_rules("presentation"), "deck", cache_size=0)
+
+    assert [mapper.map(p) for p in paths] == [
+        legacy_map(LEGACY_RULES, "deck", p) for p in paths
+    ]
+
+    results = [
+        (
+            "legacy sequential",
+            measure(lambda p: legacy_map(LEGACY_RULES, "deck", p), paths, rounds),
+        ),
+        ("compiled first-match", measure(mapper.map, paths, rounds)),
+    ]
+
+    click.echo("%d paths" % count)
+    for name, ns in results:
+        click.echo("%-22s %8.0f ns/path" % (name, ns))
+
+
+if __name__ == "__main__":
+    main()
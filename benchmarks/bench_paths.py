@@ -0,0 +1,69 @@
+# python -m benchmarks.bench_paths [--count 10000] [--rounds 5]
+import os
+from fnmatch import fnmatch
+from os.path import join, split, splitext
+
+import click
+
+from benchmarks.trees import measure, synthetic_paths
+from kudu.commands.link import (
+    InterfacePathConverter,
+    PresentationPathConverter,
+)
+from kudu.commands.push import get_name_rules
+from kudu.namerules import NameMapper
+
+PFILE = {"filename": "1234_4321.zip"}
+
+
+def legacy_presentation(relpath):
+    if fnmatch(relpath, join("iPadOnly", "*")):
+        relpath = os.sep.join(split(relpath)[1:])
+    dirname = splitext(PFILE["filename"])[0]
+    if fnmatch(relpath, "thumbnail.png"):
+        relpath = dirname + ".png"
+    return join("slides", dirname, relpath)
+
+
+def legacy_interface(relpath):
+    if fnmatch(relpath, join("interface", "*")):
+        dirname = splitext(PFILE["filename"])[0]
+        relpath = join(dirname, *split(relpath)[1:])
+    return relpath
+
+
+DIRS = ["", "css", "js", "media", "iPadOnly", "interface", join("media", "video")]
+
+
+@click.command()
+@click.option("--count", type=int, default=10000, help="Number of paths")
+@click.option("--rounds", type=int, default=5)
+def main(count, rounds):
+    paths = synthetic_paths(count, DIRS)
+    results = [
+        ("legacy presentation", measure(legacy_presentation, paths, rounds)),
+        (
+            "presentation, cold",
+            measure(PresentationPathConverter(PFILE).convert, paths, 1),
+        ),
+    ]
+
+    converter = PresentationPathConverter(PFILE)
+    measure(converter.convert, paths, 1)
+    results.append(("presentation, cached", measure(converter.convert, paths, rounds)))
+
+    results.append(("legacy interface", measure(legacy_interface, paths, rounds)))
+    results.append(
+        ("interface, cold", measure(InterfacePathConverter(PFILE).convert, paths, 1))
+    )
+
+    mapper = NameMapper(get_name_rules("presentation"), "1234_4321", cache_size=0)
+    results.append(("push presentation rules", measure(mapper.map, paths, rounds)))
+
+    click.echo("%d paths" % count)
+    for name, ns in results:
+        click.echo("%-26s %8.0f ns/path" % (name, ns))
+
+
+if __name__ == "__main__":
+    main()
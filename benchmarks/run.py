@@ -0,0 +1,251 @@
+# python -m benchmarks.run [--scale 1] [--save] [--check]
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+
+from benchmarks.trees import TREES, make_tree
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+PFILE = {"filename": "bench.zip"}
+
+
+def tree_size(root):
+    files = size = 0
+    for top, _, names in os.walk(root):
+        for name in names:
+            files += 1
+            size += os.path.getsize(os.path.join(top, name))
+    return files, size
+
+
+def peak_rss():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return rss / (1 << 20) if sys.platform == "darwin" else rss / (1 << 10)
+
+
+def case_package(src, work, jobs=1):
+    from kudu.commands.push import get_name_rules
+    from kudu.mkztemp import CompressionPolicy, mkztemp
+
+    fd, name = mkztemp(
+        "bench",
+        root_dir=src,
+        name_rules=get_name_rules("presentation"),
+        jobs=jobs,
+        policy=CompressionPolicy(),
+    )
+    os.close(fd)
+    os.remove(name)
+
+
+def case_package_parallel(src, work):
+    case_package(src, work, jobs=4)
+
+
+def case_copyfiles(src, work):
+    from kudu.commands.link import PresentationPathConverter, copyfiles
+
+    copyfiles(src, work, PresentationPathConverter(PFILE))
+
+
+def case_events(src, work, queued=False):
+    from watchdog.events import FileModifiedEvent
+
+    from kudu.commands.link import (
+        CopyFilesEventHandler,
+        EventQueue,
+        PresentationPathConverter,
+        scanfiles,
+    )
+
+    handler = CopyFilesEventHandler(src, work, PresentationPathConverter(PFILE))
+    if queued:
+        handler.queue = EventQueue(handler)
+
+    for path, _ in scanfiles(src):
+        handler.on_any_event(FileModifiedEvent(path))
+
+    if queued:
+        handler.queue.start()
+        handler.queue.stop()
+
+
+def case_events_queued(src, work):
+    case_events(src, work, queued=True)
+
+
+def case_extract(src, work):
+    from kudu.commands.pull import to_dir
+    from kudu.tests.httpserver import serve
+
+    with open(os.path.join(os.path.dirname(work), "archive.zip"), "rb") as f:
+        data = f.read()
+
+    with serve({"/bench.zip": data}) as (_, url):
+        to_dir(url + "/bench.zip", work, "bench", "presentation")
+
+
+CASES = {
+    "package": case_package,
+    "package-j4": case_package_parallel,
+    "copyfiles": case_copyfiles,
+    "events": case_events,
+    "events-queued": case_events_queued,
+    "extract": case_extract,
+}
+
+# the event cases copy one file per event, media trees add little there
+SKIP = {("events", "media"), ("events-queued", "media")}
+
+
+def run_case(case, src, work):
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        CASES[case](src, work)
+        seconds = time.perf_counter() - start
+    return seconds, peak_rss()
+
+
+def prepare(tree, scale, tmp):
+    from kudu.commands.push import get_name_rules
+    from kudu.mkztemp import mkztemp
+
+    src = os.path.join(tmp, tree)
+    make_tree(tree, src, scale)
+
+    fd, name = mkztemp("bench", root_dir=src, name_rules=get_name_rules("zip"))
+    os.close(fd)
+    shutil.move(name, os.path.join(tmp, tree + ".zip"))
+    return src
+
+
+def run(trees, cases, scale):
+    results = {}
+    tmp = tempfile.mkdtemp(prefix="kudu-bench-")
+    spawn = multiprocessing.get_context("spawn")
+
+    try:
+        for tree in trees:
+            src = prepare(tree, scale, tmp)
+            files, size = tree_size(src)
+
+            for case in cases:
+                if (case, tree) in SKIP:
+                    continue
+
+                work = os.path.join(tmp, "work", "out")
+                os.makedirs(work)
+                shutil.copy(
+                    os.path.join(tmp, tree + ".zip"),
+                    os.path.join(tmp, "work", "archive.zip"),
+                )
+
+                # a fresh process per case keeps peak rss apart
+                with ProcessPoolExecutor(1, mp_context=spawn) as executor:
+                    seconds, rss = executor.submit(run_case, case, src, work).result()
+
+                shutil.rmtree(os.path.join(tmp, "work"))
+
+                results["%s/%s" % (case, tree)] = {
+                    "seconds": round(seconds, 4),
+                    "files": files,
+                    "bytes": size,
+                    "files_per_s": round(files / seconds, 1),
+                    "mb_per_s": round(size / seconds / (1 << 20), 2),
+                    "peak_rss_mb": round(rss, 1) if rss is not None else None,
+                }
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in sorted(results.items()):
+        old = baseline.get(name)
+        if not old:
+            continue
+
+        speed = result["mb_per_s"] / old["mb_per_s"] - 1 if old["mb_per_s"] else 0
+        if speed < -tolerance:
+            regressions.append("%s is %.0f%% slower" % (name, -speed * 100))
+
+        if result["peak_rss_mb"] and old.get("peak_rss_mb"):
+            rss = result["peak_rss_mb"] / old["peak_rss_mb"] - 1
+            if rss > tolerance:
+                regressions.append("%s uses %.0f%% more memory" % (name, rss * 100))
+
+    return regressions
+
+
+@click.command()
+@click.option("--tree", "trees", multiple=True, type=click.Choice(sorted(TREES)))
+@click.option("--case", "cases", multiple=True, type=click.Choice(sorted(CASES)))
+@click.option("--scale", type=float, default=1.0, help="Size factor for the trees")
+@click.option("--baseline", type=click.Path(dir_okay=False), default=BASELINE)
+@click.option("--save", is_flag=True, help="Store the results as the new baseline")
+@click.option("--check", is_flag=True, help="Fail when results regress")
+@click.option("--tolerance", type=float, default=0.2)
+def main(trees, cases, scale, baseline, save, check, tolerance):
+    results = run(trees or sorted(TREES), cases or list(CASES), scale)
+
+    try:
+        with open(baseline, "r") as f:
+            old = json.load(f)
+    except (IOError, ValueError):
+        old = {}
+
+    click.echo(
+        "%-24s %9s %11s %9s %9s %8s"
+        % ("BENCHMARK", "SECONDS", "FILES/S", "MB/S", "RSS MB", "CHANGE")
+    )
+    for name, r in sorted(results.items()):
+        change = ""
+        if name in old and old[name]["mb_per_s"]:
+            change = "%+.0f%%" % ((r["mb_per_s"] / old[name]["mb_per_s"] - 1) * 100)
+        click.echo(
+            "%-24s %9.3f %11.1f %9.2f %9s %8s"
+            % (
+                name,
+                r["seconds"],
+                r["files_per_s"],
+                r["mb_per_s"],
+                r["peak_rss_mb"] if r["peak_rss_mb"] is not None else "-",
+                change,
+            )
+        )
+
+    regressions = compare(results, old, tolerance)
+    for regression in regressions:
+        click.echo(regression, err=True)
+
+    if save:
+        old.update(results)
+        with open(baseline, "w") as f:
+            json.dump(old, f, indent=2, sort_keys=True)
+        click.echo("Saved baseline to %s" % baseline)
+
+    if check and regressions:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import os
+import random
+import time
+from os.path import join
+
+WORDS = (
+    "pitcher slide deck video touch swipe layout brand chart frame "
+    "image audio player index style script header footer button"
+).split()
+
+
+def _text(rng, size):
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)[:size].encode()
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def small_files(root, count=2000, size=4 << 10, seed=1):
+    # html, css and js of a typical presentation, compresses well
+    rng = random.Random(seed)
+    for i in range(count):
+        ext = (".html", ".css", ".js", ".json")[i % 4]
+        _write(
+            os.path.join(root, "d%02d" % (i % 50), "f%05d%s" % (i, ext)),
+            _text(rng, size),
+        )
+    _write(os.path.join(root, "thumbnail.png"), os.urandom(16 << 10))
+
+
+def huge_media(root, count=2, size=32 << 20, seed=2):
+    # incompressible video next to a small index
+    rng = random.Random(seed)
+    for i in range(count):
+        path = os.path.join(root, "media", "video%d.mp4" % i)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            for _ in range(size >> 20):
+                f.write(rng.getrandbits(8 << 20).to_bytes(1 << 20, "little"))
+    _write(os.path.join(root, "index.html"), _text(rng, 4 << 10))
+
+
+def deep_interface(root, depth=8, fanout=2, files=4, size=2 << 10, seed=3):
+    # nested interface folders, most cost is in directory handling
+    rng = random.Random(seed)
+
+    def fill(path, level):
+        for i in range(files):
+            _write(os.path.join(path, "f%d.js" % i), _text(rng, size))
+        if level < depth:
+            for i in range(fanout):
+                fill(os.path.join(path, "n%d" % i), level + 1)
+
+    fill(os.path.join(root, "interface"), 1)
+
+
+TREES = {
+    "small": small_files,
+    "media": huge_media,
+    "deep": deep_interface,
+}
+
+
+def make_tree(name, root, scale=1.0):
+    generator = TREES[name]
+    if name == "small":
+        generator(root, count=max(1, int(2000 * scale)))
+    elif name == "media":
+        generator(root, size=max(1, int(32 * scale)) << 20)
+    else:
+        generator(root, depth=max(1, 8 + int(round(scale)) - 1))
+
+
+def synthetic_paths(count, dirs):
+    # relative paths spread over dirs, led by a thumbnail
+    return [
+        join(dirs[i % len(dirs)], "file%d.html" % i) if i else "thumbnail.png"
+        for i in range(count)
+    ]
+
+
+def measure(fn, paths, rounds):
+    # nanoseconds per path
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for path in paths:
+            fn(path)
+    return (time.perf_counter() - start) / (rounds * len(paths)) * 1e9
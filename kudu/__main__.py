@@ -1,36 +1,73 @@
 #!/usr/bin/env python
 
+from importlib import import_module
+
 import click
 
-from kudu.api import authenticate
-from kudu.commands.create import create
-from kudu.commands.init import init
-from kudu.commands.link import link
-from kudu.commands.pull import pull
-from kudu.commands.push import push
-from kudu.config import default_password, default_token, default_username
+from kudu import trace
+from kudu.api import authenticate, configure, configure_file_cache, set_credentials
+from kudu.config import (
+    default_file_cache,
+    default_http_options,
+    default_password,
+    default_token,
+    default_username,
+)
+from kudu.types import prompt_option
 
+COMMANDS = {
+    "init": "kudu.commands.init",
+    "pull": "kudu.commands.pull",
+    "push": "kudu.commands.push",
+    "link": "kudu.commands.link",
+    "create": "kudu.commands.create",
+    "deploy": "kudu.commands.deploy",
+    "logout": "kudu.commands.logout",
+}
 
-@click.group()
-@click.option(
-    "--username",
-    "-u",
-    prompt=True,
-    envvar="KUDU_USERNAME",
-    default=default_username,
-)
+
+class LazyGroup(click.Group):
+    # imports a command module only when the command is used
+    def list_commands(self, ctx):
+        return sorted(set(super(LazyGroup, self).list_commands(ctx)) | set(COMMANDS))
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name in COMMANDS and cmd_name not in self.commands:
+            module = import_module(COMMANDS[cmd_name])
+            self.add_command(getattr(module, cmd_name))
+        return super(LazyGroup, self).get_command(ctx, cmd_name)
+
+
+@click.group(cls=LazyGroup)
+@click.option("--username", "-u", envvar="KUDU_USERNAME", default=default_username)
+@click.option("--password", "-p", envvar="KUDU_PASSWORD", default=default_password)
+@click.option("--token", "-t", envvar="KUDU_TOKEN", default=default_token)
 @click.option(
-    "--password",
-    "-p",
-    prompt=True,
-    hide_input=True,
-    envvar="KUDU_PASSWORD",
-    default=default_password,
+    "--profile",
+    type=click.Path(dir_okay=False, writable=True),
+    envvar="KUDU_TRACE",
+    default=None,
+    help="Write timings of every phase to this file as Chrome trace events",
 )
-@click.option("--token", "-t", envvar="KUDU_TOKEN", default=default_token)
 @click.pass_context
-def cli(ctx, username, password, token):
-    if not token:
+def cli(ctx, username, password, token, profile=None):
+    if profile:
+        trace.start(profile)
+        ctx.call_on_close(trace.save)
+        ctx.with_resource(trace.span("kudu %s" % ctx.invoked_subcommand))
+
+    configure(**default_http_options())
+    configure_file_cache(**default_file_cache())
+
+    # logout asks for the user itself, only when it forgets a single token
+    if ctx.invoked_subcommand != "logout":
+        username = prompt_option(ctx, "username")
+        password = prompt_option(ctx, "password", hide_input=True, show_default=False)
+
+    set_credentials(username, password)
+
+    # logout must not log in again
+    if not token and ctx.invoked_subcommand != "logout":
         try:
             token = authenticate(username, password)
         except ValueError:
@@ -40,11 +77,5 @@ def cli(ctx, username, password, token):
     ctx.obj = {"username": username, "password": password, "token": token}
 
 
-cli.add_command(init)
-cli.add_command(pull)
-cli.add_command(push)
-cli.add_command(link)
-cli.add_command(create)
-
 if __name__ == "__main__":
     cli()
@@ -1,18 +1,312 @@
-import requests
+import copy
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+import click
+
+from kudu import trace
+from kudu.config import cache_dir
 
 api_url = "https://api.pitcher.com"
 pitcher_file_categories = ["presentation", "zip", "interface"]
 
+http_options = {
+    "pool_size": 10,
+    "connect_timeout": 10,
+    "read_timeout": 300,
+    "retries": 3,
+    "backoff_factor": 0.5,
+    "backoff_jitter": 0.5,
+}
 
-def request(method, url, token=None, **kwargs):
-    return getattr(requests, method)(
-        api_url + url,
-        headers={"Authorization": "Token %s" % token} if token else None,
-        **kwargs
+file_cache_options = {
+    # seconds a file record from an earlier run is used without asking the api,
+    # older ones are revalidated with their etag
+    "ttl": 0,
+    "persistent": True,
+}
+
+# retrying session and one for bodies that can only be sent once
+_sessions = {}
+_session_lock = threading.Lock()
+
+_files = {}
+_files_lock = threading.Lock()
+
+_credentials = {}
+_renewed_tokens = {}
+_auth_lock = threading.Lock()
+
+
+def configure(**options):
+    unknown = set(options) - set(http_options)
+    if unknown:
+        raise click.UsageError(
+            "Unknown http options in the config: %s" % ", ".join(sorted(unknown))
+        )
+
+    with _session_lock:
+        http_options.update(options)
+        if options:
+            for session in _sessions.values():
+                session.close()
+            _sessions.clear()
+
+
+def _retry():
+    from urllib3.util.retry import Retry
+
+    kwargs = {
+        "total": http_options["retries"],
+        "backoff_factor": http_options["backoff_factor"],
+        "status_forcelist": (429, 500, 502, 503, 504),
+        "allowed_methods": Retry.DEFAULT_ALLOWED_METHODS,
+        "raise_on_status": False,
+    }
+
+    try:
+        return Retry(backoff_jitter=http_options["backoff_jitter"], **kwargs)
+    except TypeError:
+        # urllib3 < 2 has no jitter support
+        return Retry(**kwargs)
+
+
+def get_session(retry=True):
+    # requests takes a large share of the cli startup time
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    with _session_lock:
+        session = _sessions.get(retry)
+        if session is None:
+            adapter = HTTPAdapter(
+                pool_connections=http_options["pool_size"],
+                pool_maxsize=http_options["pool_size"],
+                max_retries=_retry() if retry else 0,
+            )
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _sessions[retry] = session
+
+        return session
+
+
+def send(method, url, retry=True, **kwargs):
+    # a retry would send generator bodies again after they were consumed
+    kwargs.setdefault(
+        "timeout", (http_options["connect_timeout"], http_options["read_timeout"])
     )
+    with trace.span("http %s" % method.upper(), url=url.split("?")[0]) as args:
+        res = get_session(retry).request(method.upper(), url, **kwargs)
+        args["status"] = res.status_code
+        if "Content-Length" in res.headers:
+            args["bytes"] = int(res.headers["Content-Length"])
+        return res
+
+
+def request(method, url, token=None, **kwargs):
+    headers = dict(kwargs.pop("headers", None) or {})
+    token = _renewed_tokens.get(token, token)
+    if token:
+        headers["Authorization"] = "Token %s" % token
+
+    res = send(method, api_url + url, headers=headers or None, **kwargs)
+
+    if res.status_code == 401 and token:
+        renewed = _renew_token(token)
+        if renewed:
+            headers["Authorization"] = "Token %s" % renewed
+            res = send(method, api_url + url, headers=headers, **kwargs)
+
+    return res
+
+
+def configure_file_cache(**options):
+    unknown = set(options) - set(file_cache_options)
+    if unknown:
+        raise click.UsageError(
+            "Unknown file cache options in the config: %s" % ", ".join(sorted(unknown))
+        )
+
+    file_cache_options.update(options)
+
+
+def _file_cache_path(file_id, token=None):
+    # records differ by what the user may see, never share them
+    owner = _token_key(_credentials.get("username") or token or "")
+    digest = hashlib.sha256(owner.encode("utf-8")).hexdigest()[:16]
+    return cache_dir("files", "%d-%s.json" % (file_id, digest))
+
+
+def _load_file_entry(file_id, token=None):
+    if not file_cache_options["persistent"]:
+        return None
+
+    try:
+        with open(_file_cache_path(file_id, token), "r") as f:
+            entry = json.load(f)
+    except (IOError, ValueError):
+        return None
+
+    if entry.get("api_url") != api_url:
+        return None
+
+    return entry
+
+
+def _save_file_entry(file_id, token, entry):
+    with _files_lock:
+        _files[file_id] = entry
+
+    if not file_cache_options["persistent"]:
+        return
+
+    path = _file_cache_path(file_id, token)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+    except (IOError, OSError):
+        # the cache is only an optimization
+        pass
+
+
+def _fetch_file(file_id, token, entry=None):
+    headers = {}
+    if entry and entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+
+    res = request("get", "/files/%d/" % file_id, token=token, headers=headers)
+
+    if res.status_code == 304 and entry:
+        return dict(entry, time=time.time())
+
+    if res.status_code != 200:
+        return None
+
+    return {
+        "api_url": api_url,
+        "etag": res.headers.get("ETag"),
+        "time": time.time(),
+        "data": res.json(),
+    }
+
+
+def get_file(file_id, token=None):
+    with _files_lock:
+        entry = _files.get(file_id)
+
+    # records fetched in this process stay valid until we change them
+    if entry is not None:
+        return copy.deepcopy(entry["data"])
+
+    entry = _load_file_entry(file_id, token)
+    if entry is None or time.time() - entry["time"] >= file_cache_options["ttl"]:
+        entry = _fetch_file(file_id, token, entry)
+        if entry is None:
+            return None
+        _save_file_entry(file_id, token, entry)
+    else:
+        with _files_lock:
+            _files[file_id] = entry
+
+    return copy.deepcopy(entry["data"])
+
+
+def invalidate_file(file_id):
+    with _files_lock:
+        _files.pop(file_id, None)
+
+    # the record changed for every user
+    prefix = "%d-" % file_id
+    try:
+        with os.scandir(cache_dir("files")) as it:
+            for entry in it:
+                if entry.name.startswith(prefix):
+                    os.remove(entry.path)
+    except OSError:
+        pass
+
+
+def _token_path():
+    return cache_dir("tokens.json")
+
+
+def _token_key(username):
+    return "%s@%s" % (username, api_url)
+
+
+def _read_tokens():
+    try:
+        with open(_token_path(), "r") as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _write_tokens(tokens):
+    path = _token_path()
+    try:
+        os.makedirs(os.path.dirname(path), 0o700, exist_ok=True)
+        # mkstemp creates the file readable by the owner only
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "w") as f:
+            json.dump(tokens, f)
+        os.replace(tmp_path, path)
+    except (IOError, OSError):
+        pass
+
+
+def save_token(username, token):
+    tokens = _read_tokens()
+    tokens[_token_key(username)] = token
+    _write_tokens(tokens)
+
+
+def forget_token(username=None):
+    tokens = _read_tokens()
+    if username is None:
+        tokens = {}
+    else:
+        tokens.pop(_token_key(username), None)
+    _write_tokens(tokens)
+
+
+def set_credentials(username, password):
+    _credentials.update(username=username, password=password)
+
+
+def _renew_token(token):
+    if not _credentials.get("username") or not _credentials.get("password"):
+        return None
+
+    with _auth_lock:
+        if token not in _renewed_tokens:
+            try:
+                renewed = authenticate(
+                    _credentials["username"], _credentials["password"], cached=False
+                )
+            except ValueError:
+                return None
+            _renewed_tokens[token] = renewed
+        return _renewed_tokens[token]
+
+
+def authenticate(username, password, cached=True):
+    set_credentials(username, password)
 
+    if cached:
+        token = _read_tokens().get(_token_key(username))
+        if token:
+            return token
 
-def authenticate(username, password):
     res = request(
         "post", "/auth/user/", json={"username": username, "password": password}
     )
@@ -20,4 +314,6 @@ def authenticate(username, password):
     if res.status_code != 200:
         raise ValueError
 
-    return res.json().get("token")
+    token = res.json().get("token")
+    save_token(username, token)
+    return token
@@ -0,0 +1,179 @@
+import hashlib
+import os
+import tempfile
+import time
+import zipfile
+from contextlib import contextmanager
+
+import click
+
+from kudu import api, filecopy
+from kudu.config import cache_dir
+
+CHUNK_SIZE = 1 << 20
+# temp files of killed pulls are removed after this many seconds
+STALE = 24 * 3600
+
+cache_options = {
+    "enabled": True,
+    # least recently used archives are removed above this many bytes
+    "max_size": 2 << 30,
+}
+
+
+def configure(**options):
+    unknown = set(options) - set(cache_options)
+    if unknown:
+        raise click.UsageError(
+            "Unknown archive cache options in the config: %s"
+            % ", ".join(sorted(unknown))
+        )
+
+    cache_options.update(options)
+
+
+def archive_key(pf):
+    # every push sets a new creationTime, the same key means the same content
+    version = pf.get("creationTime")
+    if not cache_options["enabled"] or not version or "id" not in pf:
+        return None
+
+    digest = hashlib.sha256(
+        ("%s:%s:%s" % (api.api_url, pf["id"], version)).encode("utf-8")
+    ).hexdigest()
+    return digest + os.path.splitext(pf.get("filename") or "")[1]
+
+
+def _path(key):
+    return cache_dir("archives", key)
+
+
+def lookup(key):
+    if key is None:
+        return None
+
+    path = _path(key)
+    try:
+        # the modification time orders entries for pruning
+        os.utime(path)
+    except OSError:
+        return None
+    return path
+
+
+def partial_path(key):
+    # a stable path lets an interrupted download resume, prune removes it
+    # once it is stale
+    return cache_dir("archives", ".partial-" + key)
+
+
+def discard(key):
+    if key is not None:
+        _remove(_path(key))
+
+
+def _complete(key, path, size=None):
+    if size is not None and os.path.getsize(path) != size:
+        return False
+    # an error body must never become the cached version
+    return not key.endswith(".zip") or zipfile.is_zipfile(path)
+
+
+def store(key, src_path):
+    if key is None or not _complete(key, src_path):
+        return
+
+    try:
+        # atomic, concurrent pulls replace each other with the same content
+        filecopy.place_file(src_path, _path(key), filecopy.AUTO)
+    except OSError:
+        return
+    prune()
+
+
+class _TeeReader:
+    def __init__(self, fp, out):
+        self.fp = fp
+        self.out = out
+        self.failed = False
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        if not self.failed:
+            try:
+                self.out.write(data)
+            except OSError:
+                # a full cache disk must not fail the pull
+                self.failed = True
+        return data
+
+
+@contextmanager
+def caching(res, key):
+    # yields a reader of the response that also writes everything read into
+    # the cache, committed only when a successful response was read in full
+    fp = res.raw
+    if key is None or not 200 <= res.status_code < 300:
+        yield fp
+        return
+
+    size = res.headers.get("Content-Length")
+    # the raw body of an encoded response differs from Content-Length
+    size = int(size) if size and not res.headers.get("Content-Encoding") else None
+
+    path = _path(key)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".kudu-")
+    except OSError:
+        yield fp
+        return
+
+    try:
+        with os.fdopen(fd, "wb") as out:
+            tee = _TeeReader(fp, out)
+            yield tee
+
+            # the central directory follows the last member
+            while tee.read(CHUNK_SIZE):
+                pass
+
+        if not tee.failed and _complete(key, tmp_path, size):
+            os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    prune()
+
+
+def prune(max_size=None):
+    if max_size is None:
+        max_size = cache_options["max_size"]
+
+    entries = []
+    now = time.time()
+    try:
+        with os.scandir(cache_dir("archives")) as it:
+            for entry in it:
+                st = entry.stat()
+                if entry.name.startswith("."):
+                    if now - st.st_mtime > STALE:
+                        _remove(entry.path)
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+    except OSError:
+        return
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        _remove(path)
+        total -= size
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
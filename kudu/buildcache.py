@@ -0,0 +1,134 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+from kudu.config import cache_dir
+
+# least recently saved builds are removed above this many bytes
+MAX_SIZE = 1 << 30
+
+
+def build_cache_dir(root_dir):
+    # outside of the tree, so it never ends up in git, links or archives
+    path = os.path.abspath(root_dir).encode("utf-8")
+    return cache_dir("builds", hashlib.sha256(path).hexdigest()[:16])
+
+
+def _tree_size(top):
+    size = 0
+    for root, dirs, files in os.walk(top):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return size
+
+
+def prune(max_size=MAX_SIZE, keep=None):
+    # every root, also those of ci workspaces that never come back
+    builds = []
+    try:
+        with os.scandir(cache_dir("builds")) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    st = entry.stat()
+                    builds.append((st.st_mtime, _tree_size(entry.path), entry.path))
+    except OSError:
+        return
+
+    total = sum(size for _, size, _ in builds)
+    for _, size, path in sorted(builds):
+        if total <= max_size:
+            break
+        if path != keep:
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+class BuildCache:
+    def __init__(self, root_dir=None):
+        self.root_dir = root_dir or os.curdir
+        self.path = build_cache_dir(self.root_dir)
+        self.index_path = os.path.join(self.path, "index.json")
+        self.objects_path = os.path.join(self.path, "objects")
+
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.used = set()
+
+        try:
+            with open(self.index_path, "r") as f:
+                self.index = json.load(f)
+        except (IOError, ValueError):
+            self.index = {}
+
+    def _key(self, filename):
+        return os.path.relpath(filename, self.root_dir).replace(os.sep, "/")
+
+    def _object_name(self, sha, compress_type, level):
+        return "%s-%d-%s" % (sha, compress_type, level)
+
+    def _object_path(self, name):
+        return os.path.join(self.objects_path, name[:2], name)
+
+    def get(self, filename, st, compress_type, level):
+        key = self._key(filename)
+        entry = self.index.get(key)
+        if not entry:
+            return None
+
+        size, mtime_ns, sha, crc = entry
+        if size != st.st_size or mtime_ns != st.st_mtime_ns:
+            return None
+
+        name = self._object_name(sha, compress_type, level)
+        try:
+            raw = open(self._object_path(name), "rb")
+        except IOError:
+            return None
+
+        with self.lock:
+            self.entries[key] = entry
+            self.used.add(name)
+
+        return crc, raw
+
+    def put(self, filename, st, sha, crc, compress_type, level, raw):
+        name = self._object_name(sha, compress_type, level)
+        path = self._object_path(name)
+
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, "wb") as f:
+                while True:
+                    chunk = raw.read(1 << 20)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+            os.replace(tmp_path, path)
+            raw.seek(0)
+
+        with self.lock:
+            self.entries[self._key(filename)] = [st.st_size, st.st_mtime_ns, sha, crc]
+            self.used.add(name)
+
+    def save(self):
+        os.makedirs(self.path, exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.index_path)
+
+        # only keep the members of the last build
+        for root, dirs, files in os.walk(self.objects_path):
+            for name in files:
+                if name not in self.used:
+                    os.remove(os.path.join(root, name))
+
+        prune(keep=self.path)
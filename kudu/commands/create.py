@@ -1,11 +1,21 @@
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import click
-import requests
 
 from kudu.api import request
-from kudu.commands.push import get_file_data, update_file_metadata
+from kudu.commands.push import (
+    Stages,
+    echo_summary,
+    get_build_cache,
+    get_compression_policy,
+    get_file_manifest,
+    update_file_metadata,
+    upload_file_data,
+)
+from kudu.mkztemp import ARCHIVE_SPOOL_SIZE, PackageSummary
+from kudu.upload import PART_SIZE
 
 
 @click.command()
@@ -25,28 +35,116 @@ from kudu.commands.push import get_file_data, update_file_metadata
     default="zip",
     help="Extension of the file that's going to be uploaded, default 'zip'",
 )
+@click.option(
+    "--stream",
+    is_flag=True,
+    default=False,
+    help="Compress while uploading if the upload target allows it, presigned "
+    "S3 urls need a Content-Length and always upload a finished archive",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=0),
+    default=1,
+    help="Number of compression threads, 0 uses all cores",
+)
+@click.option(
+    "--cache/--no-cache",
+    default=True,
+    help="Reuse compressed members of the last build of the same path",
+)
+@click.option(
+    "--part-size",
+    type=click.IntRange(min=0),
+    default=PART_SIZE >> 20,
+    help="Upload archives in parts of this many MB, 0 disables multipart uploads",
+)
+@click.option(
+    "--connections",
+    "-c",
+    type=click.IntRange(min=1),
+    default=4,
+    help="Number of concurrent connections for multipart uploads",
+)
+@click.option(
+    "--spool-size",
+    type=click.IntRange(min=0),
+    default=ARCHIVE_SPOOL_SIZE >> 20,
+    help="Package archives up to this many MB in memory, 0 always uses a temp file",
+)
+@click.option(
+    "--timings", is_flag=True, default=False, help="Show how long every stage took"
+)
 @click.pass_context
-def create(ctx, instance, body, filename=None, path=None, extension="zip"):
+def create(
+    ctx,
+    instance,
+    body,
+    filename=None,
+    path=None,
+    extension="zip",
+    stream=False,
+    jobs=1,
+    cache=True,
+    part_size=PART_SIZE >> 20,
+    connections=4,
+    spool_size=ARCHIVE_SPOOL_SIZE >> 20,
+    timings=False,
+):
     base_name = (
         os.path.splitext(filename)[0]
         if filename
         else str(int(round(time.time() * 1000)))
     )
+    stages = Stages()
+
+    # the manifest does not depend on the new file
+    with ThreadPoolExecutor(1) as executor:
+        created = executor.submit(
+            create_file,
+            ctx.obj["token"],
+            instance,
+            body,
+            extension,
+            filename=filename,
+            stages=stages,
+        )
+        with stages.span("manifest") as args:
+            manifest = get_file_manifest(path, base_name, extension)
+            args["files"] = len(manifest)
+        file_id = created.result()
 
-    file_data = get_file_data(path, base_name, category=extension)
-    file_id = create_file(
-        ctx.obj["token"], instance, body, extension, filename=filename
-    )
-    url = "/files/%d/upload-url/" % file_id
-    response = request("get", url, token=ctx.obj["token"])
     # upload data
-    requests.put(response.json(), data=file_data)
+    summary = PackageSummary()
+    upload_file_data(
+        ctx.obj["token"],
+        file_id,
+        path,
+        base_name,
+        extension,
+        stream,
+        part_size << 20,
+        connections,
+        jobs=jobs,
+        policy=get_compression_policy(),
+        stages=stages,
+        spool_size=spool_size << 20,
+        summary=summary,
+        cache=get_build_cache(path) if cache else None,
+    )
+    echo_summary(path, summary)
 
     # touch file
-    update_file_metadata(ctx, file_id)
+    update_file_metadata(ctx, file_id, manifest, stages)
+
+    if timings:
+        click.echo(stages)
+
 
+def create_file(token, app_id, file_body, category, filename=None, stages=None):
+    stages = stages or Stages()
 
-def create_file(token, app_id, file_body, category, filename=None):
     payload = {
         "app": app_id,
         "body": file_body,
@@ -58,7 +156,9 @@ def create_file(token, app_id, file_body, category, filename=None):
     if filename:
         payload["filename"] = filename
 
-    res = request("post", "/files/", json=payload, token=token)
+    with stages.span("create file", instance=app_id) as args:
+        res = request("post", "/files/", json=payload, token=token)
+        args["status"] = res.status_code
     json = res.json()
 
     if res.status_code != 201 and res.status_code != 200:
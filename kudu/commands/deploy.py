@@ -0,0 +1,140 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+
+from kudu import api, trace
+from kudu.commands.create import create_file
+from kudu.commands.push import (
+    get_build_cache,
+    get_compression_policy,
+    get_file_manifest,
+    update_file_metadata,
+    upload_file_data,
+)
+from kudu.config import read_config
+from kudu.manifest import MANIFEST_DIGEST_KEY, manifest_digest
+from kudu.mkztemp import PackageSummary
+from kudu.types import PitcherFileType
+
+PUSH_CATEGORIES = ("zip", "presentation", "json", "")
+
+
+def load_deploy_manifest(path):
+    config = read_config(path)
+    entries = config.get("files") if isinstance(config, dict) else None
+
+    if not isinstance(entries, list):
+        raise click.BadParameter("%s has no list of files" % path)
+
+    for entry in entries:
+        if not isinstance(entry, dict) or "path" not in entry:
+            raise click.BadParameter("Every file needs a path: %r" % entry)
+
+        if ("id" in entry) == ("create" in entry):
+            raise click.BadParameter("Every file needs either an id or create spec")
+
+        spec = entry.get("create")
+        if spec is not None and not (
+            isinstance(spec, dict) and "instance" in spec and "body" in spec
+        ):
+            raise click.BadParameter("create needs an instance and body: %r" % spec)
+
+        # paths are relative to the manifest
+        entry["path"] = os.path.join(os.path.dirname(path), entry["path"])
+
+    return entries
+
+
+def deploy_file(ctx, entry, force=False):
+    token = ctx.obj["token"]
+    path = entry["path"]
+    spec = entry.get("create")
+
+    if spec:
+        extension = spec.get("extension", "zip")
+        filename = spec.get("filename")
+        base_name = (
+            os.path.splitext(filename)[0]
+            if filename
+            else str(int(round(time.time() * 1000)))
+        )
+        file_id = create_file(
+            token, spec["instance"], spec["body"], extension, filename=filename
+        )
+        category, metadata = extension, {}
+    else:
+        pf = PitcherFileType(category=PUSH_CATEGORIES).convert(entry["id"], None, ctx)
+        file_id = pf["id"]
+        base_name, _ = os.path.splitext(pf["filename"])
+        category, metadata = pf["category"], pf.get("metadata") or {}
+
+    manifest = get_file_manifest(path, base_name, category)
+    if not force and metadata.get(MANIFEST_DIGEST_KEY) == manifest_digest(manifest):
+        return file_id, "unchanged"
+
+    upload_file_data(
+        token,
+        file_id,
+        path,
+        base_name,
+        category,
+        show_progress=False,
+        policy=get_compression_policy(),
+        summary=PackageSummary(),
+        cache=get_build_cache(path),
+    )
+    update_file_metadata(ctx, file_id, manifest)
+
+    return file_id, "created" if spec else "pushed"
+
+
+def _timed_deploy(ctx, entry, force):
+    start = time.time()
+    try:
+        with trace.span("deploy", path=entry["path"]) as args:
+            file_id, status = deploy_file(ctx, entry, force)
+            args["status"] = status
+    except click.ClickException as e:
+        file_id, status = entry.get("id"), "failed: %s" % e.format_message()
+    except SystemExit:
+        # create_file already reported the error
+        file_id, status = entry.get("id"), "failed"
+    except Exception as e:
+        file_id, status = entry.get("id"), "failed: %s" % e
+    return file_id, entry["path"], status, time.time() - start
+
+
+@click.command()
+@click.argument("manifest", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=1),
+    default=4,
+    help="Number of files deployed at the same time",
+)
+@click.option("--force", is_flag=True, default=False, help="Push unchanged files")
+@click.pass_context
+def deploy(ctx, manifest, jobs=4, force=False):
+    entries = load_deploy_manifest(manifest)
+
+    # every worker keeps its connection in the shared pool
+    if api.http_options["pool_size"] < jobs:
+        api.configure(pool_size=jobs)
+
+    with ThreadPoolExecutor(jobs) as executor:
+        results = list(
+            executor.map(lambda entry: _timed_deploy(ctx, entry, force), entries)
+        )
+
+    width = max([len(str(r[1])) for r in results] + [4])
+    click.echo("%-10s %-*s %8s  %s" % ("FILE", width, "PATH", "SECONDS", "RESULT"))
+    for file_id, path, status, elapsed in results:
+        click.echo(
+            "%-10s %-*s %8.1f  %s" % (file_id or "-", width, path, elapsed, status)
+        )
+
+    if any(r[2].startswith("failed") for r in results):
+        exit(1)
@@ -1,6 +1,6 @@
 import click
 
-from kudu.api import request
+from kudu.api import get_file, request
 from kudu.config import write_config
 
 
@@ -42,13 +42,13 @@ def create_file(token):
 
 
 def validate_file(file_id, token):
-    api_res = request("get", "/files/%d/" % file_id, token=token)
+    data = get_file(file_id, token=token)
 
-    if api_res.status_code != 200:
+    if data is None:
         click.echo("Invalid file", err=True)
         exit(1)
 
-    if api_res.json().get("category") not in ("zip", "presentation", ""):
+    if data.get("category") not in ("zip", "presentation", ""):
         click.echo("Invalid category", err=True)
         exit(1)
 
@@ -1,140 +1,348 @@
 import os
+import re
+import threading
 import time
-from fnmatch import fnmatch
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from os import getcwd
-from os.path import join, split, splitext
-from shutil import copyfile
+from os.path import join, splitext
 
 import click
 from watchdog.events import (
     EVENT_TYPE_CREATED,
+    EVENT_TYPE_DELETED,
     EVENT_TYPE_MODIFIED,
     EVENT_TYPE_MOVED,
     FileSystemEventHandler,
 )
 from watchdog.observers import Observer
 
+from kudu import filecopy, trace
 from kudu.config import default_file_id
 from kudu.defaults import default_pitcher_folders
+from kudu.manifest import hash_file
+from kudu.namerules import FNMATCH_FLAGS, NameMapper, NameRule, relpath
+from kudu.progress import Progress
 from kudu.types import PitcherFileType
 
+COPY, MOVE, DELETE = "copy", "move", "delete"
+
+# top level folders of a source that are never linked
+IGNORED = (".kudu",)
+
+SEPARATORS = re.escape(os.sep + (os.altsep or ""))
+SEP = "[%s]" % SEPARATORS
+NAME = "([^%s]*)" % SEPARATORS
+
 
 class PitcherFilePathConverter(object):
     def __init__(self, pfile):
         self.pfile = pfile
+        self.base_name = splitext(pfile["filename"])[0]
+        self.mapper = NameMapper(self.name_rules(), self.base_name)
 
-    def convert(self, relpath):
+    def name_rules(self):
         raise NotImplementedError()
 
+    def convert(self, relpath):
+        return self.mapper.map(relpath)
+
+    def roots(self):
+        # destination folders that only hold files of this pitcher file
+        return []
+
+
+# fnmatch("dir/*") also matches nested files, which are flattened to their name
+def _flatten_rule(dirname, name_pattern, path):
+    return NameRule(
+        re.escape(dirname) + r"%s(?:.*%s)?%s\Z" % (SEP, SEP, name_pattern),
+        path,
+        FNMATCH_FLAGS,
+    )
+
 
 class InteractivePathConverter(PitcherFilePathConverter):
     basedir = "zip"
 
-    def convert(self, relpath):
-        dirname = splitext(self.pfile["filename"])[0]
-        if fnmatch(relpath, "thumbnail.png"):
-            relpath = dirname + ".png"
-        return join(self.basedir, dirname, relpath)
+    def roots(self):
+        return [join(self.basedir, self.base_name)]
+
+    def name_rules(self):
+        return [
+            NameRule(r"thumbnail\.png\Z", self.thumbnail_path(), FNMATCH_FLAGS),
+            NameRule(r"(.*)", (self.basedir, "{base_name}", "{0}"), re.DOTALL),
+        ]
+
+    def thumbnail_path(self):
+        return join(self.basedir, "{base_name}", "{base_name}.png")
 
 
 class PresentationPathConverter(InteractivePathConverter):
     basedir = "slides"
 
-    def convert(self, relpath):
-        if fnmatch(relpath, join("iPadOnly", "*")):
-            relpath = os.sep.join(split(relpath)[1:])
-        return super(PresentationPathConverter, self).convert(relpath)
+    def name_rules(self):
+        return [
+            _flatten_rule("iPadOnly", r"thumbnail\.png", self.thumbnail_path()),
+            _flatten_rule("iPadOnly", NAME, (self.basedir, "{base_name}", "{0}")),
+        ] + super(PresentationPathConverter, self).name_rules()
 
 
 class InterfacePathConverter(PitcherFilePathConverter):
-    def convert(self, relpath):
-        if fnmatch(relpath, join("interface", "*")):
-            dirname = splitext(self.pfile["filename"])[0]
-            relpath = join(dirname, *split(relpath)[1:])
-        return relpath
+    def roots(self):
+        return [self.base_name]
+
+    def name_rules(self):
+        return [_flatten_rule("interface", NAME, ("{base_name}", "{0}"))]
 
 
 class CopyFilesEventHandler(FileSystemEventHandler):
-    def __init__(self, src, dst, converter):
+    def __init__(self, src, dst, converter, queue=None, mode=filecopy.COPY):
         self.src = src
         self.dst = dst
         self.converter = converter
+        self.queue = queue
+        self.mode = mode
 
-    def on_any_event(self, event):
-        if (
-            event.event_type
-            in [EVENT_TYPE_MODIFIED, EVENT_TYPE_MOVED, EVENT_TYPE_CREATED]
-            and not event.is_directory
-        ):
-            src_path = (
-                event.src_path
-                if event.event_type != EVENT_TYPE_MOVED
-                else event.dest_path
-            )
-            src_relpath = os.path.relpath(src_path)
+    def _dst_path(self, src_path):
+        return join(self.dst, self.converter.convert(relpath(src_path, self.src)))
 
-            dst_relpath = self.converter.convert(src_relpath)
-            dst_path = join(self.dst, dst_relpath)
-            dst_dirpath = os.path.dirname(dst_path)
+    def _linked(self, path):
+        path = os.path.relpath(path, self.src)
+        return not path.startswith(os.pardir) and not is_ignored(path)
 
-            if not os.path.exists(dst_dirpath):
-                os.makedirs(dst_dirpath)
+    def on_any_event(self, event):
+        if event.is_directory or is_ignored(relpath(event.src_path, self.src)):
+            return
+
+        if event.event_type in (EVENT_TYPE_MODIFIED, EVENT_TYPE_CREATED):
+            change = (COPY, event.src_path, None)
+        elif event.event_type == EVENT_TYPE_MOVED and self._linked(event.dest_path):
+            change = (MOVE, event.dest_path, event.src_path)
+        elif event.event_type in (EVENT_TYPE_MOVED, EVENT_TYPE_DELETED):
+            change = (DELETE, event.src_path, None)
+        else:
+            return
+
+        if self.queue is not None:
+            self.queue.put(change)
+        else:
+            self.apply(change)
+
+    def apply(self, change):
+        action, src_path, old_path = change
+        src_relpath = relpath(src_path, self.src)
+        dst_path = self._dst_path(src_path)
+
+        try:
+            if action == DELETE:
+                if os.path.exists(dst_path):
+                    os.remove(dst_path)
+                    click.echo("Deleted file: %s" % src_relpath)
+                return
+
+            if action == MOVE:
+                old_dst_path = self._dst_path(old_path)
+                if os.path.exists(old_dst_path):
+                    os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+                    os.replace(old_dst_path, dst_path)
+                    click.echo("Moved file: %s" % src_relpath)
+                    return
 
             click.echo("Copying file: %s" % src_relpath, nl=False)
+            syncfile(src_path, os.stat(src_path), dst_path, self.mode)
+            click.echo("\rCopying file: %s, done." % src_relpath)
+        except (IOError, OSError) as e:
+            # File most likely does not exist
+            click.echo(e, err=True)
+
+
+class EventQueue(object):
+    # merges changes per path until the source is quiet for `quiet` seconds
+    def __init__(self, handler, quiet=0.2, jobs=8):
+        self.handler = handler
+        self.quiet = quiet
+        self.jobs = jobs
+        self.pending = OrderedDict()
+        self.last_event = 0
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.thread.join()
+
+    def put(self, change):
+        action, path, old_path = change
+
+        with self.condition:
+            if action == MOVE:
+                previous = self.pending.pop(old_path, None)
+                if previous is not None and previous[0] != MOVE:
+                    # the old copy is stale or gone, copy the new path instead
+                    self.pending[old_path] = (DELETE, old_path, None)
+                    change = (COPY, path, None)
+                elif previous is not None:
+                    change = (MOVE, path, previous[2])
+
+            replaced = self.pending.pop(path, None)
+            if replaced is not None and replaced[0] == MOVE:
+                # the renamed copy is stale or gone, remove it instead of renaming
+                self.pending.setdefault(replaced[2], (DELETE, replaced[2], None))
+            self.pending[path] = change
+            self.last_event = time.time()
+            self.condition.notify()
+
+    def _take_batch(self):
+        with self.condition:
+            while not self.stopped:
+                if self.pending:
+                    wait = self.last_event + self.quiet - time.time()
+                    if wait <= 0:
+                        break
+                else:
+                    wait = None
+                self.condition.wait(wait)
+
+            batch, self.pending = list(self.pending.values()), OrderedDict()
+            return batch
+
+    def _run(self):
+        with ThreadPoolExecutor(self.jobs) as executor:
+            while True:
+                batch = self._take_batch()
+                self.flush(batch, executor)
+                if self.stopped:
+                    return
+
+    def flush(self, batch, executor):
+        # a rename from a path another rename replaces would move the wrong
+        # file, as in swaps through a temp name, copy those instead
+        targets = {change[1] for change in batch if change[0] == MOVE}
+        batch = [
+            (
+                (COPY, change[1], None)
+                if change[0] == MOVE and change[2] in targets
+                else change
+            )
+            for change in batch
+        ]
+        copies = [change for change in batch if change[0] == COPY]
 
-            try:
-                copyfile(src_path, dst_path)
-                click.echo("\rCopying file: %s, done." % src_relpath)
-            except (IOError, OSError) as e:
-                # File most likely does not exist
-                click.echo(e, err=True)
+        with trace.span("sync batch", changes=len(batch), files=len(copies)):
+            # renames and deletes first, they may free paths the copies need
+            for change in batch:
+                if change[0] != COPY:
+                    self.handler.apply(change)
 
-            click.echo("\rCopying file: %s, done." % src_relpath)
+            list(executor.map(self.handler.apply, copies))
 
 
-def countfiles(top):
-    click.echo("Counting files", nl=False)
+def is_ignored(relpath):
+    return relpath.split(os.sep, 1)[0] in IGNORED
 
-    count = 0
-    for root, dirs, files in os.walk(top):
-        count += len(files)
-        click.echo("\rCounting files: %d" % count, nl=False)
 
-    click.echo("\rCounting files: %d, done." % count)
-    return count
+def scanfiles(top, ignore=()):
+    stack = [top]
+    while stack:
+        root = stack.pop()
+        with os.scandir(root) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    if root != top or entry.name not in ignore:
+                        stack.append(entry.path)
+                elif entry.is_file():
+                    yield entry.path, entry.stat()
 
 
-def copyfiles(src, dst, converter):
-    total = countfiles(src)
-    curr = 0
+def is_uptodate(src_path, src_stat, dst_path, checksum=False):
+    try:
+        dst_stat = os.stat(dst_path)
+    except OSError:
+        return False
 
-    if not os.path.exists(dst):
-        os.makedirs(dst, 0o755)
+    if dst_stat.st_size != src_stat.st_size:
+        return False
 
-    click.echo("Copying files", nl=False)
+    if checksum:
+        return hash_file(src_path) == hash_file(dst_path)
 
-    for root, dirs, files in os.walk(src):
-        for name in files:
-            curr += 1
-            click.echo("\rCopying files: %d/%d" % (curr, total), nl=False)
+    return dst_stat.st_mtime_ns == src_stat.st_mtime_ns
 
-            src_path = os.path.join(root, name)
-            src_relpath = os.path.relpath(src_path)
 
-            dst_relpath = converter.convert(src_relpath)
-            dst_path = join(dst, dst_relpath)
-            dst_dirpath = os.path.dirname(dst_path)
+def syncfile(src_path, src_stat, dst_path, mode=filecopy.COPY):
+    filecopy.place_file(src_path, dst_path, mode)
+    # matching mtimes mark the copy as up to date for the next sync
+    os.utime(dst_path, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
 
-            if not os.path.exists(dst_dirpath):
-                os.makedirs(dst_dirpath)
 
-            copyfile(join(root, name), dst_path)
+def deleteorphans(dst, converter, expected):
+    deleted = 0
+    for root in converter.roots():
+        root = join(dst, root)
+        if not os.path.isdir(root):
+            continue
+        for dst_path, _ in scanfiles(root):
+            if os.path.normcase(dst_path) not in expected:
+                os.remove(dst_path)
+                deleted += 1
+    return deleted
 
-    click.echo("\rCopying files: %d/%d, done." % (curr, total))
 
+def copyfiles(
+    src, dst, converter, jobs=8, checksum=False, delete=False, mode=filecopy.COPY
+):
+    if not os.path.exists(dst):
+        os.makedirs(dst, 0o755)
+
+    pending = []
+    expected = set()
+    total = 0
+
+    with trace.span("scan") as args, Progress("Scanning files") as progress:
+        for src_path, src_stat in scanfiles(src, IGNORED):
+            total += 1
+            dst_path = join(dst, converter.convert(relpath(src_path, src)))
+            expected.add(os.path.normcase(dst_path))
+
+            if not is_uptodate(src_path, src_stat, dst_path, checksum):
+                pending.append((src_path, src_stat, dst_path, mode))
+            progress.update(1)
+        args["files"] = total
+
+    click.echo("Changed files: %d of %d" % (len(pending), total))
+
+    size = sum(src_stat.st_size for _, src_stat, _, _ in pending)
+    with trace.span("copy", files=len(pending), bytes=size), Progress(
+        "Copying files", len(pending), size
+    ) as progress:
+        with ThreadPoolExecutor(max(1, jobs)) as executor:
+            futures = {
+                executor.submit(syncfile, *args): args[1].st_size for args in pending
+            }
+            for future in as_completed(futures):
+                future.result()
+                progress.update(1, futures[future])
+
+    deleted = 0
+    if delete:
+        with trace.span("delete orphans") as args:
+            deleted = args["files"] = deleteorphans(dst, converter, expected)
+        click.echo("Deleted files: %d" % deleted)
+
+    return len(pending), total - len(pending), deleted
+
+
+def watchfiles(src, dst, converter, quiet=0.2, jobs=8, mode=filecopy.COPY):
+    event_handler = CopyFilesEventHandler(src, dst, converter, mode=mode)
+    event_handler.queue = EventQueue(event_handler, quiet, jobs)
+    event_handler.queue.start()
 
-def watchfiles(src, dst, converter):
-    event_handler = CopyFilesEventHandler(src, dst, converter)
     observer = Observer()
     observer.schedule(event_handler, src, recursive=True)
     observer.start()
@@ -144,6 +352,7 @@ def watchfiles(src, dst, converter):
     except KeyboardInterrupt:
         observer.stop()
     observer.join()
+    event_handler.queue.stop()
 
 
 @click.command()
@@ -162,7 +371,47 @@ def watchfiles(src, dst, converter):
     type=click.Path(exists=True, file_okay=False, writable=True),
     default=lambda: default_pitcher_folders(),
 )
-def link(pfile, pitcher_folders):
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=1),
+    default=8,
+    help="Number of files copied at the same time",
+)
+@click.option(
+    "--checksum",
+    is_flag=True,
+    default=False,
+    help="Compare file contents instead of size and modification time",
+)
+@click.option(
+    "--delete",
+    is_flag=True,
+    default=False,
+    help="Delete files in the linked folder that are not in the source",
+)
+@click.option(
+    "--quiet-window",
+    type=click.FloatRange(min=0),
+    default=0.2,
+    help="Seconds without changes before changed files are copied",
+)
+@click.option(
+    "--mode",
+    type=click.Choice(filecopy.MODES),
+    default=filecopy.AUTO,
+    help="How files are placed in the linked folder, auto uses reflinks "
+    "where the filesystem supports them",
+)
+def link(
+    pfile,
+    pitcher_folders,
+    jobs=8,
+    checksum=False,
+    delete=False,
+    quiet_window=0.2,
+    mode=filecopy.AUTO,
+):
     cwd = getcwd()
 
     if pfile["category"] == "zip":
@@ -174,5 +423,5 @@ def link(pfile, pitcher_folders):
     else:
         raise NotImplementedError()
 
-    copyfiles(cwd, pitcher_folders, converter)
-    watchfiles(cwd, pitcher_folders, converter)
+    copyfiles(cwd, pitcher_folders, converter, jobs, checksum, delete, mode)
+    watchfiles(cwd, pitcher_folders, converter, quiet_window, jobs, mode)
@@ -0,0 +1,18 @@
+import click
+
+from kudu.api import forget_token
+from kudu.types import prompt_option
+
+
+@click.command()
+@click.option(
+    "--all",
+    "all_users",
+    is_flag=True,
+    default=False,
+    help="Forget the tokens of all users",
+)
+@click.pass_context
+def logout(ctx, all_users=False):
+    forget_token(None if all_users else prompt_option(ctx.parent, "username"))
+    click.echo("Logged out")
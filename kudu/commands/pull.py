@@ -1,31 +1,48 @@
 import os
 import tempfile
+import zlib
 from os import walk
 from os.path import exists, isdir, join, relpath
 from shutil import copyfileobj, move, rmtree
-from zipfile import ZipFile
+from zipfile import BadZipFile, ZipFile
 
 import click
-import requests
 
+from kudu import archivecache, filecopy, trace
 from kudu.api import request as api_request
-from kudu.config import default_file_id
+from kudu.api import send
+from kudu.config import default_archive_cache, default_file_id
+from kudu.download import discard, download
+from kudu.progress import Progress
+from kudu.remotezip import HTTPRangeFile, RangeNotSupported
 from kudu.types import PitcherFileType
+from kudu.zipstream import UnsupportedZipStream, extract_stream, member_parts
 
 
-def unpack_url(url):
-    tmphandle, tmppath = tempfile.mkstemp(suffix=".zip")
-    tmpfile = os.fdopen(tmphandle, "r+b")
-
-    res = requests.get(url, stream=True)
+def unpack_url(url, connections=4, key=None):
+    if key is not None:
+        tmppath = archivecache.partial_path(key)
+        os.makedirs(os.path.dirname(tmppath), exist_ok=True)
+    else:
+        tmphandle, tmppath = tempfile.mkstemp(suffix=".zip")
+        os.close(tmphandle)
 
-    copyfileobj(res.raw, tmpfile)
-    tmpfile.close()
+    try:
+        with Progress("Downloading") as progress:
+            download(url, tmppath, connections, progress=progress)
+    except BaseException:
+        # only the stable path of a cached version is resumed
+        if key is None:
+            discard(tmppath)
+        raise
 
-    with ZipFile(tmppath, "r") as z:
-        z.extractall()
+    try:
+        archivecache.store(key, tmppath)
 
-    os.remove(tmppath)
+        with ZipFile(tmppath, "r") as z:
+            z.extractall()
+    finally:
+        os.remove(tmppath)
 
 
 def _move(src, dst):
@@ -38,11 +55,42 @@ def _move(src, dst):
     rmtree(src)
 
 
-def to_dir(url, root_dir, base_dir, file_category):
+def member_mapper(base_dir, file_category):
+    target = [] if file_category else ["interface"]
+    thumb_filename = base_dir + ".png"
+
+    def mapper(parts):
+        if parts[0] == base_dir and len(parts) > 1:
+            parts = target + parts[1:]
+
+        if parts == [thumb_filename]:
+            parts = ["thumbnail.png"]
+
+        return parts
+
+    return mapper
+
+
+def to_dir(url, root_dir, base_dir, file_category, connections=4, key=None):
+    res = send("get", url, stream=True)
+    res.raise_for_status()
+
+    try:
+        with trace.span("extract") as args, Progress("Extracting") as progress:
+            mapper = member_mapper(base_dir, file_category)
+            with archivecache.caching(res, key) as fp:
+                args["files"] = extract_stream(fp, root_dir, mapper, progress)
+    except UnsupportedZipStream:
+        res.close()
+        unpack_to_dir(url, root_dir, base_dir, file_category, connections, key)
+
+
+def unpack_to_dir(url, root_dir, base_dir, file_category, connections=4, key=None):
     save_cwd = os.getcwd()
     os.chdir(root_dir)
 
-    unpack_url(url)
+    with trace.span("download and unpack"):
+        unpack_url(url, connections, key)
 
     if exists(base_dir):
         _move(base_dir, os.curdir if file_category else "interface")
@@ -54,10 +102,108 @@ def to_dir(url, root_dir, base_dir, file_category):
     os.chdir(save_cwd)
 
 
-def to_file(download_url, path):
-    res = requests.get(download_url, stream=True)
-    with open(path, "w+b") as f:
-        copyfileobj(res.raw, f)
+def _file_crc32(path):
+    crc = 0
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(1 << 20)
+            if not chunk:
+                return crc
+            crc = zlib.crc32(chunk, crc)
+
+
+def _is_current(path, zinfo):
+    try:
+        if os.path.getsize(path) != zinfo.file_size:
+            return False
+    except OSError:
+        return False
+
+    return _file_crc32(path) == zinfo.CRC
+
+
+def extract_members(zf, root_dir, mapper, check=False, before_read=None):
+    infos = [i for i in zf.infolist() if not i.is_dir()]
+    updated = 0
+
+    label = "Checking files" if check else "Extracting"
+    with Progress(label, len(infos)) as progress:
+        for zinfo in infos:
+            progress.update(1)
+            parts = member_parts(zinfo.filename)
+            if not parts:
+                continue
+
+            path = join(root_dir, *mapper(parts))
+            if check and _is_current(path, zinfo):
+                continue
+
+            if before_read:
+                before_read(zinfo)
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with zf.open(zinfo) as src, open(path, "wb") as dst:
+                copyfileobj(src, dst, 1 << 20)
+            updated += 1
+
+    return infos, updated
+
+
+def sync_dir(url, root_dir, base_dir, file_category):
+    mapper = member_mapper(base_dir, file_category)
+
+    try:
+        rf = HTTPRangeFile(url)
+    except RangeNotSupported as e:
+        # the server sent the whole archive instead, or an error
+        e.response.raise_for_status()
+        extract_stream(e.response.raw, root_dir, mapper)
+        return
+
+    with ZipFile(rf) as zf:
+        offsets = sorted(i.header_offset for i in zf.infolist()) + [zf.start_dir]
+        next_offsets = dict(zip(offsets, offsets[1:]))
+
+        def before_read(zinfo):
+            # fetch this member with a single range request
+            rf.limit = next_offsets[zinfo.header_offset]
+
+        infos, updated = extract_members(zf, root_dir, mapper, True, before_read)
+
+    click.echo(
+        "Updated %d of %d files, downloaded %d of %d bytes (saved %d bytes)"
+        % (
+            updated,
+            len(infos),
+            rf.bytes_fetched,
+            rf.size,
+            max(0, rf.size - rf.bytes_fetched),
+        )
+    )
+
+
+def to_file(download_url, path, connections=4, key=None):
+    with trace.span("download") as args, Progress("Downloading") as progress:
+        download(download_url, path, connections, progress=progress)
+        args["bytes"] = os.path.getsize(path)
+    archivecache.store(key, path)
+
+
+def from_cache(cached, pf, path, sync=False):
+    if isdir(path):
+        filename_root, filename_ext = os.path.splitext(pf["filename"])
+
+        if filename_ext == ".zip":
+            mapper = member_mapper(filename_root, pf["category"])
+            with ZipFile(cached) as zf:
+                infos, updated = extract_members(zf, path, mapper, sync)
+            if sync:
+                click.echo("Updated %d of %d files from cache" % (updated, len(infos)))
+            return
+
+        path = join(path, pf["filename"])
+
+    filecopy.place_file(cached, path, filecopy.AUTO)
 
 
 @click.command()
@@ -70,18 +216,55 @@ def to_file(download_url, path):
     default=default_file_id,
 )
 @click.option("--path", "-p", type=click.Path(), default=lambda: os.getcwd())
+@click.option(
+    "--sync",
+    is_flag=True,
+    default=False,
+    help="Only download files that differ from the ones in path",
+)
+@click.option(
+    "--connections",
+    "-c",
+    type=click.IntRange(min=1),
+    default=4,
+    help="Number of concurrent connections for downloads",
+)
+@click.option(
+    "--cache/--no-cache",
+    default=True,
+    help="Reuse archives of the same file version pulled before",
+)
 @click.pass_context
-def pull(ctx, pf, path):
-    download_url = api_request(
-        "get", "/files/%d/download-url/" % pf["id"], token=ctx.obj["token"]
-    ).json()
+def pull(ctx, pf, path, sync=False, connections=4, cache=True):
+    archivecache.configure(**default_archive_cache())
+    key = archivecache.archive_key(pf) if cache else None
+
+    cached = archivecache.lookup(key)
+    if cached:
+        try:
+            with trace.span("from cache"):
+                from_cache(cached, pf, path, sync)
+            return
+        except FileNotFoundError:
+            # another pull pruned the entry in the meantime
+            pass
+        except BadZipFile:
+            archivecache.discard(key)
+
+    with trace.span("download url"):
+        download_url = api_request(
+            "get", "/files/%d/download-url/" % pf["id"], token=ctx.obj["token"]
+        ).json()
 
     if isdir(path):
         filename_root, filename_ext = os.path.splitext(pf["filename"])
 
-        if filename_ext == ".zip":
-            to_dir(download_url, path, filename_root, pf["category"])
+        if filename_ext == ".zip" and sync:
+            with trace.span("sync"):
+                sync_dir(download_url, path, filename_root, pf["category"])
+        elif filename_ext == ".zip":
+            to_dir(download_url, path, filename_root, pf["category"], connections, key)
         else:
-            to_file(download_url, join(path, pf["filename"]))
+            to_file(download_url, join(path, pf["filename"]), connections, key)
     else:
-        to_file(download_url, path)
+        to_file(download_url, path, connections, key)
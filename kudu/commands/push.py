@@ -1,22 +1,55 @@
+import calendar
+import inspect
 import os
+import threading
+import time
 from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
 from datetime import datetime
+from urllib.parse import parse_qs, urlparse
 
 import click
-import requests
 
+from kudu import trace
+from kudu.api import get_file, invalidate_file
 from kudu.api import request as api_request
-from kudu.config import default_file_id
-from kudu.mkztemp import NameRule, mkztemp
+from kudu.api import send
+from kudu.buildcache import BuildCache
+from kudu.config import default_compression, default_file_id
+from kudu.manifest import (
+    MANIFEST_DIGEST_KEY,
+    MANIFEST_KEY,
+    build_manifest,
+    diff_manifest,
+    load_manifest,
+    manifest_digest,
+    save_manifest,
+)
+from kudu.mkztemp import (
+    ARCHIVE_SPOOL_SIZE,
+    CompressionPolicy,
+    PackageSummary,
+    mkzspool,
+    mkzstream,
+    walk_entries,
+)
+from kudu.namerules import NameRule
+from kudu.progress import Progress
 from kudu.types import PitcherFileType
+from kudu.upload import PART_SIZE, file_size, is_multipart, upload
 
 CategoryRule = namedtuple("crule", ("category", "rule"))
 
+# presigned urls expiring sooner than this are fetched again before uploading
+EXPIRY_MARGIN = 300
+
 
 CATEGORY_RULES = (
     CategoryRule("", NameRule((r"^interface", r"(.+)"), ("{base_name}", "{0}"))),
     CategoryRule(
-        ("presentation", "zip"), NameRule(r"^thumbnail.png", "{base_name}.png")
+        ("presentation", "zip"),
+        NameRule(r"^thumbnail.png", ("{base_name}", "{base_name}.png")),
     ),
     CategoryRule(("presentation", "zip"), NameRule(r"(.+)", ("{base_name}", "{0}"))),
 )  # yapf: disable
@@ -32,49 +65,471 @@ CATEGORY_RULES = (
     default=default_file_id,
 )
 @click.option("--path", "-p", type=click.Path(exists=True), default=None)
+@click.option(
+    "--stream",
+    is_flag=True,
+    default=False,
+    help="Compress while uploading if the upload target allows it, presigned "
+    "S3 urls need a Content-Length and always upload a finished archive",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=0),
+    default=1,
+    help="Number of compression threads, 0 uses all cores",
+)
+@click.option(
+    "--cache/--no-cache",
+    default=True,
+    help="Reuse compressed members of the last build of the same path",
+)
+@click.option(
+    "--part-size",
+    type=click.IntRange(min=0),
+    default=PART_SIZE >> 20,
+    help="Upload archives in parts of this many MB, 0 disables multipart uploads",
+)
+@click.option(
+    "--connections",
+    "-c",
+    type=click.IntRange(min=1),
+    default=4,
+    help="Number of concurrent connections for multipart uploads",
+)
+@click.option(
+    "--spool-size",
+    type=click.IntRange(min=0),
+    default=ARCHIVE_SPOOL_SIZE >> 20,
+    help="Package archives up to this many MB in memory, 0 always uses a temp file",
+)
+@click.option("--force", is_flag=True, default=False, help="Push unchanged files")
+@click.option(
+    "--plan", is_flag=True, default=False, help="Show changes without pushing"
+)
+@click.option(
+    "--timings", is_flag=True, default=False, help="Show how long every stage took"
+)
 @click.pass_context
-def push(ctx, pf, path):
+def push(
+    ctx,
+    pf,
+    path,
+    stream=False,
+    jobs=1,
+    cache=True,
+    part_size=PART_SIZE >> 20,
+    connections=4,
+    spool_size=ARCHIVE_SPOOL_SIZE >> 20,
+    force=False,
+    plan=False,
+    timings=False,
+):
     name = pf["filename"]
     base_name, _ = os.path.splitext(name)
+    stages = Stages()
+
+    with stages.span("manifest") as args:
+        manifest = get_file_manifest(path, base_name, pf["category"])
+        args["files"] = len(manifest)
+    remote_metadata = pf.get("metadata") or {}
 
-    url = "/files/%d/upload-url/" % pf["id"]
-    response = api_request("get", url, token=ctx.obj["token"])
+    if plan:
+        echo_plan(remote_metadata, manifest)
+        return
 
-    data = get_file_data(path, base_name, pf["category"])
+    if not force and remote_metadata.get(MANIFEST_DIGEST_KEY) == manifest_digest(
+        manifest
+    ):
+        click.echo("No changes since the last push, use --force to push anyway")
+        return
 
     # upload data
-    requests.put(response.json(), data=data)
+    summary = PackageSummary()
+    upload_file_data(
+        ctx.obj["token"],
+        pf["id"],
+        path,
+        base_name,
+        pf["category"],
+        stream,
+        part_size << 20,
+        connections,
+        jobs=jobs,
+        policy=get_compression_policy(),
+        stages=stages,
+        spool_size=spool_size << 20,
+        summary=summary,
+        cache=get_build_cache(path) if cache else None,
+    )
+    echo_summary(path, summary)
 
     # touch file
-    update_file_metadata(ctx, pf["id"])
+    update_file_metadata(ctx, pf["id"], manifest, stages)
+
+    if timings:
+        click.echo(stages)
+
+
+class Stages:
+    # seconds spent in every stage of a push, stages on worker threads overlap
+    def __init__(self):
+        self.seconds = {}
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, **args):
+        start = time.perf_counter()
+        try:
+            with trace.span(name, **args) as span_args:
+                yield span_args
+        finally:
+            with self.lock:
+                self.seconds[name] = (
+                    self.seconds.get(name, 0.0) + time.perf_counter() - start
+                )
+
+    def __str__(self):
+        with self.lock:
+            stages = ", ".join("%s %.2fs" % item for item in self.seconds.items())
+        return "Stages: %s (%.2fs in total)" % (
+            stages or "none",
+            time.perf_counter() - self.start,
+        )
+
+
+def echo_plan(remote_metadata, manifest):
+    if remote_metadata.get(MANIFEST_DIGEST_KEY) == manifest_digest(manifest):
+        click.echo("No changes")
+        return
+
+    remote_manifest = load_manifest(remote_metadata.get(MANIFEST_DIGEST_KEY))
+    if remote_manifest is None:
+        click.echo(
+            "No manifest of the last push on this machine, all %d files would be pushed"
+            % len(manifest)
+        )
+        return
+
+    added, removed, changed = diff_manifest(remote_manifest, manifest)
+    for prefix, names in (("+", added), ("-", removed), ("~", changed)):
+        for name in names:
+            click.echo("%s %s" % (prefix, name))
+
+    click.echo(
+        "%d added, %d removed, %d changed" % (len(added), len(removed), len(changed))
+    )
+
+
+def get_name_rules(category):
+    return [c.rule for c in CATEGORY_RULES if category in c.category]
+
+
+def get_compression_policy():
+    options = default_compression()
+    unknown = set(options) - set(inspect.signature(CompressionPolicy).parameters)
+    if unknown:
+        raise click.UsageError(
+            "Unknown compression options in the config: %s" % ", ".join(sorted(unknown))
+        )
+    return CompressionPolicy(**options)
+
+
+def get_build_cache(path):
+    if path is None or os.path.isdir(path):
+        return BuildCache(path)
+
+
+def echo_summary(path, summary):
+    if path is None or os.path.isdir(path):
+        click.echo(summary)
+
+
+def get_file_manifest(path, base_name, category):
+    if path is None or os.path.isdir(path):
+        entries = walk_entries(
+            base_name, root_dir=path, name_rules=get_name_rules(category)
+        )
+    else:
+        entries = [(path, os.path.basename(path))]
+
+    return build_manifest(entries)
+
 
+def get_file_data(
+    path, base_name, category, stages=None, spool_size=ARCHIVE_SPOOL_SIZE, **options
+):
+    stages = stages or Stages()
 
-def get_file_data(path, base_name, category):
     if path is None or os.path.isdir(path):
-        rules = [c.rule for c in CATEGORY_RULES if category in c.category]
-        fp, _ = mkztemp(base_name, root_dir=path, name_rules=rules)
-        data = os.fdopen(fp, "r+b")
+        rules = get_name_rules(category)
+        with stages.span("package") as args:
+            data = mkzspool(
+                base_name,
+                root_dir=path,
+                name_rules=rules,
+                max_size=spool_size,
+                **options
+            )
+            args["bytes"] = file_size(data)
+            if options.get("summary") is not None:
+                summary = options["summary"]
+                args["files"] = summary.stored[0] + summary.deflated[0]
     else:
-        data = open(path, "r+b")
+        data = open(path, "rb")
 
     return data
 
 
-def update_file_metadata(ctx, file_id):
+def needs_content_length(upload_url):
+    # presigned S3 urls reject chunked transfer encoding
+    query = parse_qs(urlparse(upload_url).query)
+    return "X-Amz-Signature" in query or "Signature" in query
+
+
+def presigned_expiry(url):
+    query = parse_qs(urlparse(url).query)
+    try:
+        if "X-Amz-Date" in query and "X-Amz-Expires" in query:
+            signed = time.strptime(query["X-Amz-Date"][0], "%Y%m%dT%H%M%SZ")
+            return calendar.timegm(signed) + int(query["X-Amz-Expires"][0])
+        if "Expires" in query:
+            return int(query["Expires"][0])
+    except ValueError:
+        pass
+    return None
+
+
+def target_expiry(target):
+    if is_multipart(target):
+        urls = target["parts"] + [target["complete"]]
+    else:
+        urls = [target] if isinstance(target, str) else []
+    expiries = [e for e in map(presigned_expiry, urls) if e is not None]
+    return min(expiries) if expiries else None
+
+
+def archive_size_bound(path, base_name, category):
+    if path is not None and not os.path.isdir(path):
+        return os.path.getsize(path)
+
+    # zip64 and classic end of central directory records
+    size = 98
+    entries = walk_entries(
+        base_name, root_dir=path, name_rules=get_name_rules(category)
+    )
+    for filename, arcname in entries:
+        file_size = os.path.getsize(filename)
+        # worst case deflate expansion, both headers and a data descriptor
+        size += file_size + (file_size >> 10) + 256 + 2 * len(arcname.encode("utf-8"))
+    return size
+
+
+def get_upload_url(token, file_id, parts=None, stages=None):
+    stages = stages or Stages()
+    url = "/files/%d/upload-url/" % file_id
+    params = {"parts": parts} if parts else None
+    with stages.span("upload url", parts=parts):
+        return api_request("get", url, token=token, params=params).json()
+
+
+def prefetch_upload_url(token, file_id, path, base_name, category, part_size, stages):
+    # enough parts for any archive of the files, unused part urls are free
+    size = archive_size_bound(path, base_name, category)
+    parts = -(-size // part_size) if part_size and size > part_size else None
+    return get_upload_url(token, file_id, parts, stages)
+
+
+class UploadTarget:
+    # hands out the url fetched while the archive was built, unless it has too
+    # few parts or expires before the upload is under way
+    def __init__(self, token, file_id, stages, prefetched=None):
+        self.token = token
+        self.file_id = file_id
+        self.stages = stages
+        self.prefetched = prefetched
+
+    def usable(self, target, parts):
+        # a single url takes the whole archive in one request
+        if parts and is_multipart(target) and len(target["parts"]) < parts:
+            return False
+
+        expiry = target_expiry(target)
+        return expiry is None or expiry - time.time() > EXPIRY_MARGIN
+
+    def __call__(self, parts):
+        prefetched, self.prefetched = self.prefetched, None
+        if prefetched is not None:
+            try:
+                target = prefetched.result()
+            except Exception:
+                # fetching it again reports the error
+                target = None
+            if target and self.usable(target, parts):
+                return target
+
+        return get_upload_url(self.token, self.file_id, parts, self.stages)
+
+
+def upload_file_data(
+    token,
+    file_id,
+    path,
+    base_name,
+    category,
+    stream=False,
+    part_size=PART_SIZE,
+    connections=4,
+    show_progress=True,
+    stages=None,
+    spool_size=ARCHIVE_SPOOL_SIZE,
+    **options
+):
+    stages = stages or Stages()
+    with ThreadPoolExecutor(2) as executor:
+        # update_file_metadata reads the current record after the upload
+        executor.submit(get_file, file_id, token)
+        res = _upload_file_data(
+            executor,
+            token,
+            file_id,
+            path,
+            base_name,
+            category,
+            stream,
+            part_size,
+            connections,
+            show_progress,
+            stages,
+            spool_size,
+            **options
+        )
+
+    # the manifest digest must only be recorded for uploaded content
+    if not 200 <= res.status_code < 300:
+        raise click.ClickException("Upload failed with status %d" % res.status_code)
+    return res
+
+
+def _upload_file_data(
+    executor,
+    token,
+    file_id,
+    path,
+    base_name,
+    category,
+    stream,
+    part_size,
+    connections,
+    show_progress,
+    stages,
+    spool_size,
+    **options
+):
+    packing = path is None or os.path.isdir(path)
+    upload_url = None
+
+    if stream and packing:
+        upload_url = get_upload_url(token, file_id, stages=stages)
+
+        # presigned S3 urls go straight to the spooled archive below, only
+        # targets that take chunked bodies are streamed
+        if not needs_content_length(upload_url):
+            with stages.span("package and upload") as args, _progress(
+                "Packaging and uploading", show_progress
+            ) as progress:
+                chunks = mkzstream(
+                    base_name,
+                    root_dir=path,
+                    name_rules=get_name_rules(category),
+                    progress=progress,
+                    **options
+                )
+                res = send("put", upload_url, retry=False, data=chunks)
+                args["status"] = res.status_code
+
+            # the target wants a Content-Length after all
+            if res.status_code not in (411, 501):
+                return res
+
+    if upload_url is not None:
+        # the url fetched for streaming takes the spooled archive as well
+        prefetched = Future()
+        prefetched.set_result(upload_url)
+    else:
+        prefetched = executor.submit(
+            prefetch_upload_url,
+            token,
+            file_id,
+            path,
+            base_name,
+            category,
+            part_size,
+            stages,
+        )
+    get_target = UploadTarget(token, file_id, stages, prefetched)
+
+    if packing:
+        with _progress("Packaging", show_progress) as progress:
+            data = get_file_data(
+                path,
+                base_name,
+                category,
+                stages,
+                spool_size,
+                progress=progress,
+                **options
+            )
+    else:
+        data = get_file_data(path, base_name, category, stages)
+
+    with data:
+        size = file_size(data)
+        start = time.time()
+        with stages.span("upload", bytes=size) as args, _progress(
+            "Uploading", show_progress, size=size
+        ) as progress:
+            res = upload(
+                data, get_target, part_size, connections, progress, key=file_id
+            )
+            args["status"] = res.status_code
+        if not show_progress:
+            echo_throughput(size, start)
+        return res
+
+
+def _progress(label, show=True, **totals):
+    return Progress(label, **totals) if show else nullcontext()
+
+
+def echo_throughput(size, start):
+    elapsed = max(time.time() - start, 1e-6)
+    click.echo(
+        "Uploaded %.1f MB in %.1fs (%.1f MB/s)"
+        % (size / 1048576.0, elapsed, size / 1048576.0 / elapsed)
+    )
+
+
+def update_file_metadata(ctx, file_id, manifest=None, stages=None):
+    stages = stages or Stages()
+
     # touch file
     url = "/files/%d/" % file_id
-    json = {
-        "creationTime": datetime.utcnow().isoformat(),
-        "metadata": get_metadata_with_github_info(ctx, file_id),
-    }
-    api_request("patch", url, json=json, token=ctx.obj["token"])
+    with stages.span("metadata", file_id=file_id) as args:
+        json = {
+            "creationTime": datetime.utcnow().isoformat(),
+            "metadata": get_metadata_with_github_info(ctx, file_id, manifest),
+        }
+        res = api_request("patch", url, json=json, token=ctx.obj["token"])
+        args["status"] = res.status_code
+    invalidate_file(file_id)
 
 
-def get_metadata_with_github_info(ctx, file_id):
+def get_metadata_with_github_info(ctx, file_id, manifest=None):
     # first get existing metadata then modify it
-    url = "/files/%d/" % file_id
-    response = api_request("get", url, token=ctx.obj["token"]).json()
-    metadata = response.get("metadata", {})
+    response = get_file(file_id, token=ctx.obj["token"]) or {}
+    metadata = response.get("metadata") or {}
 
     # NOT losing repo info for non-github deployments
     current_repo_info = metadata.get("GITHUB_REPOSITORY", "not_available")
@@ -86,4 +541,11 @@ def get_metadata_with_github_info(ctx, file_id):
     metadata["GITHUB_SHA"] = os.environ.get("GITHUB_SHA", "not_available")
     metadata["GITHUB_RUN_ID"] = os.environ.get("GITHUB_RUN_ID", "not_available")
 
+    # lets the next push skip unchanged content, the per-file manifest for
+    # --plan stays on this machine
+    metadata.pop(MANIFEST_KEY, None)
+    if manifest is not None:
+        metadata[MANIFEST_DIGEST_KEY] = manifest_digest(manifest)
+        save_manifest(manifest)
+
     return metadata
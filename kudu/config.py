@@ -1,14 +1,22 @@
-from os.path import expanduser
+import copy
+import os
+from os.path import expanduser, join
 
-import yaml
+CONFIG_PATHS = ("~/.kudu.yml", ".kudu.yml")
+
+_config_cache = {}
 
 
 def write_config(data, path=".kudu.yml"):
+    import yaml
+
     with open(path, "w+") as stream:
         yaml.safe_dump(data, stream, default_flow_style=False, allow_unicode=True)
 
 
 def read_config(path=".kudu.yml"):
+    import yaml
+
     try:
         with open(path, "r+") as stream:
             try:
@@ -30,13 +38,27 @@ def merge_config(self, other):
             self[key] = value
 
 
+def _stat_key(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return os.path.abspath(path), None
+    return os.path.abspath(path), st.st_mtime_ns, st.st_size
+
+
 def load_config():
-    config = {}
+    # every click default reads the config, parse it once while it is unchanged
+    paths = [expanduser(path) for path in CONFIG_PATHS]
+    key = tuple(_stat_key(path) for path in paths)
 
-    for path in (expanduser("~/.kudu.yml"), ".kudu.yml"):
-        merge_config(config, read_config(path))
+    if key not in _config_cache:
+        config = {}
+        for path in paths:
+            merge_config(config, read_config(path))
+        _config_cache.clear()
+        _config_cache[key] = config
 
-    return config
+    return copy.deepcopy(_config_cache[key])
 
 
 def default_username():
@@ -57,3 +79,26 @@ def default_file_id():
 
 def default_pitcher_folders():
     return load_config().get("pitcher_folders")
+
+
+def default_http_options():
+    return load_config().get("http") or {}
+
+
+def default_compression():
+    return load_config().get("compression") or {}
+
+
+def default_file_cache():
+    return load_config().get("file_cache") or {}
+
+
+def default_archive_cache():
+    return load_config().get("archive_cache") or {}
+
+
+def cache_dir(*paths):
+    root = os.environ.get("KUDU_CACHE_DIR") or join(
+        os.environ.get("XDG_CACHE_HOME") or expanduser("~/.cache"), "kudu"
+    )
+    return join(root, *paths)
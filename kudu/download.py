@@ -0,0 +1,190 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from shutil import copyfileobj
+
+from kudu.api import send
+
+SEGMENT_SIZE = 8 << 20
+CHUNK_SIZE = 1 << 20
+RETRIES = 3
+
+CONTENT_RANGE = re.compile(r"bytes (\d+)-(\d+)/(\d+)")
+MD5_ETAG = re.compile(r'^"?([0-9a-f]{32})"?$')
+STATE_SUFFIX = ".kudu-download"
+
+
+class DownloadError(IOError):
+    pass
+
+
+class _State:
+    def __init__(self, path, size, etag):
+        self.path = path + STATE_SUFFIX
+        self.size = size
+        self.etag = etag
+        self.done = set()
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return False
+
+        if data.get("size") != self.size or data.get("etag") != self.etag:
+            return False
+
+        self.done = set(data.get("done", []))
+        return True
+
+    def mark_done(self, start):
+        with self.lock:
+            self.done.add(start)
+            data = {"size": self.size, "etag": self.etag, "done": sorted(self.done)}
+
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or None)
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _write_range(path, start, chunks, progress=None):
+    with open(path, "r+b") as f:
+        f.seek(start)
+        for chunk in chunks:
+            f.write(chunk)
+            if progress is not None:
+                progress.update(size=len(chunk))
+        return f.tell() - start
+
+
+def _fetch_segment(url, path, state, start, end, progress=None):
+    for attempt in range(RETRIES):
+        try:
+            res = send(
+                "get", url, headers={"Range": "bytes=%d-%d" % (start, end)}, stream=True
+            )
+            if res.status_code != 206:
+                raise DownloadError("Unexpected status %d" % res.status_code)
+
+            written = _write_range(path, start, res.iter_content(CHUNK_SIZE), progress)
+            if written != end - start + 1:
+                raise DownloadError("Incomplete segment %d-%d" % (start, end))
+            state.mark_done(start)
+            return
+        except (IOError, OSError):
+            if attempt == RETRIES - 1:
+                raise
+
+
+def _md5_etag(res):
+    # etags of objects encrypted with kms or customer keys are no md5
+    if res.headers.get("x-amz-server-side-encryption", "AES256") != "AES256":
+        return None
+    if res.headers.get("x-amz-server-side-encryption-customer-algorithm"):
+        return None
+    return res.headers.get("ETag")
+
+
+def discard(path):
+    # removes a partial download and its resume state
+    for name in (path, path + STATE_SUFFIX):
+        if os.path.exists(name):
+            os.remove(name)
+
+
+def _verify(path, size, etag):
+    if os.path.getsize(path) != size:
+        raise DownloadError("Size mismatch for %s" % path)
+
+    # single part uploads have the md5 of the object as ETag
+    m = MD5_ETAG.match(etag or "")
+    if m:
+        h = hashlib.md5()
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                h.update(chunk)
+        if h.hexdigest() != m.group(1):
+            raise DownloadError("Checksum mismatch for %s" % path)
+
+
+def download(url, path, connections=4, segment_size=SEGMENT_SIZE, progress=None):
+    # the first segment doubles as probe for size and range support
+    res = send(
+        "get", url, headers={"Range": "bytes=0-%d" % (segment_size - 1)}, stream=True
+    )
+    m = CONTENT_RANGE.match(res.headers.get("Content-Range", ""))
+
+    if res.status_code == 416:
+        # empty object
+        open(path, "wb").close()
+        return
+
+    if res.status_code not in (200, 206) or (res.status_code == 206 and not m):
+        res.close()
+        raise DownloadError("Unexpected status %d for %s" % (res.status_code, url))
+
+    if res.status_code == 200:
+        with open(path, "wb") as f:
+            if progress is None:
+                copyfileobj(res.raw, f)
+                return
+            for chunk in res.iter_content(CHUNK_SIZE):
+                f.write(chunk)
+                progress.update(size=len(chunk))
+        return
+
+    size = int(m.group(3))
+    state = _State(path, size, res.headers.get("ETag"))
+
+    if not (state.load() and os.path.exists(path) and os.path.getsize(path) == size):
+        state.done = set()
+        with open(path, "wb") as f:
+            f.truncate(size)
+
+    if progress is not None:
+        progress.total_size = size
+        # segments of an interrupted download count as done
+        progress.update(size=sum(min(segment_size, size - s) for s in state.done))
+
+    if 0 not in state.done and int(m.group(1)) == 0:
+        try:
+            written = _write_range(path, 0, res.iter_content(CHUNK_SIZE), progress)
+        except (IOError, OSError):
+            written = None
+        # a short first segment is fetched again with the others
+        if written == int(m.group(2)) + 1:
+            state.mark_done(0)
+    res.close()
+
+    segments = [
+        (start, min(start + segment_size, size) - 1)
+        for start in range(0, size, segment_size)
+        if start not in state.done
+    ]
+
+    with ThreadPoolExecutor(max(1, connections)) as executor:
+        futures = [
+            executor.submit(_fetch_segment, url, path, state, start, end, progress)
+            for start, end in segments
+        ]
+        for future in futures:
+            future.result()
+
+    try:
+        _verify(path, size, _md5_etag(res))
+    finally:
+        state.remove()
@@ -0,0 +1,126 @@
+import errno
+import os
+import shutil
+import sys
+import tempfile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+COPY, HARDLINK, REFLINK, AUTO = "copy", "hardlink", "reflink", "auto"
+MODES = (COPY, HARDLINK, REFLINK, AUTO)
+
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+
+# errors of filesystems or devices that do not support a method
+UNSUPPORTED = {
+    errno.EXDEV,
+    errno.EOPNOTSUPP,
+    errno.ENOTSUP,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTTY,
+    errno.EPERM,
+    errno.EMLINK,
+}
+
+# (src device, dst device) -> methods that failed before
+_unsupported = {}
+
+
+def _umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# mkstemp creates 0600, placed files get the mode open() would give them
+FILE_MODE = 0o666 & ~_umask()
+
+
+def _reflink(src_path, tmp_path):
+    if sys.platform == "darwin":
+        import ctypes
+
+        libc = ctypes.CDLL(None, use_errno=True)
+        os.remove(tmp_path)
+        if libc.clonefile(os.fsencode(src_path), os.fsencode(tmp_path), 0):
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), tmp_path)
+        return
+
+    if fcntl is None:
+        raise OSError(errno.ENOTSUP, "Reflinks are not supported", tmp_path)
+
+    with open(src_path, "rb") as src, open(tmp_path, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def _copy_range(src_path, tmp_path):
+    if not hasattr(os, "copy_file_range"):
+        raise OSError(errno.ENOSYS, "copy_file_range is not available", tmp_path)
+
+    with open(src_path, "rb") as src, open(tmp_path, "wb") as dst:
+        size = os.fstat(src.fileno()).st_size
+        copied = 0
+        while copied < size:
+            n = os.copy_file_range(src.fileno(), dst.fileno(), size - copied)
+            if n == 0:
+                break
+            copied += n
+
+
+def _hardlink(src_path, tmp_path):
+    os.remove(tmp_path)
+    os.link(src_path, tmp_path)
+
+
+def _copy(src_path, tmp_path):
+    shutil.copyfile(src_path, tmp_path)
+
+
+METHODS = {
+    COPY: [_copy],
+    HARDLINK: [_hardlink, _copy],
+    REFLINK: [_reflink, _copy_range, _copy],
+    # hardlinks share later edits with the source, so auto never uses them
+    AUTO: [_reflink, _copy_range, _copy],
+}
+
+
+def place_file(src_path, dst_path, mode=COPY):
+    dst_dir = os.path.dirname(dst_path) or os.curdir
+    os.makedirs(dst_dir, exist_ok=True)
+
+    devices = (os.stat(src_path).st_dev, os.stat(dst_dir).st_dev)
+    unsupported = _unsupported.setdefault(devices, set())
+    if devices[0] != devices[1]:
+        unsupported.update((_reflink, _hardlink))
+
+    fd, tmp_path = tempfile.mkstemp(dir=dst_dir, prefix=".kudu-")
+    os.close(fd)
+
+    try:
+        for method in METHODS[mode]:
+            if method in unsupported and method is not _copy:
+                continue
+            try:
+                method(src_path, tmp_path)
+            except OSError as e:
+                if e.errno not in UNSUPPORTED or method is _copy:
+                    raise
+                unsupported.add(method)
+                if not os.path.exists(tmp_path):
+                    open(tmp_path, "wb").close()
+                continue
+            # a hardlink shares the mode of its source
+            if method is not _hardlink:
+                os.chmod(tmp_path, FILE_MODE)
+            os.replace(tmp_path, dst_path)
+            return method.__name__.lstrip("_")
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
@@ -0,0 +1,95 @@
+import hashlib
+import json
+import os
+import tempfile
+
+from kudu.config import cache_dir
+
+# earlier versions stored the whole manifest in the file metadata
+MANIFEST_KEY = "KUDU_MANIFEST"
+MANIFEST_DIGEST_KEY = "KUDU_MANIFEST_DIGEST"
+
+# manifests of the most recent pushes kept for --plan
+KEEP_MANIFESTS = 20
+
+
+def hash_file(filename, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def build_manifest(entries):
+    manifest = {}
+    for filename, arcname in entries:
+        manifest[arcname.replace("\\", "/")] = hash_file(filename)
+    return manifest
+
+
+def manifest_digest(manifest):
+    data = json.dumps(sorted(manifest.items()), separators=(",", ":"))
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def _manifest_path(digest):
+    return cache_dir("manifests", digest + ".json")
+
+
+def save_manifest(manifest):
+    # keyed by digest, the file metadata only holds the digest
+    path = _manifest_path(manifest_digest(manifest))
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, path)
+    except (IOError, OSError):
+        return
+
+    _prune_manifests()
+
+
+def load_manifest(digest):
+    if not digest:
+        return None
+
+    try:
+        with open(_manifest_path(digest), "r") as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        return None
+
+    return manifest if isinstance(manifest, dict) else None
+
+
+def _prune_manifests():
+    root = cache_dir("manifests")
+    try:
+        paths = [os.path.join(root, name) for name in os.listdir(root)]
+        paths.sort(key=os.path.getmtime, reverse=True)
+        for path in paths[KEEP_MANIFESTS:]:
+            os.remove(path)
+    except OSError:
+        pass
+
+
+def diff_manifest(old, new):
+    added, removed, changed = [], [], []
+
+    for name in sorted(set(old) | set(new)):
+        if name not in old:
+            added.append(name)
+        elif name not in new:
+            removed.append(name)
+        else:
+            size = min(len(old[name]), len(new[name]))
+            if old[name][:size] != new[name][:size]:
+                changed.append(name)
+
+    return added, removed, changed
@@ -1,52 +1,518 @@
+import hashlib
+import io
 import os
-import re
+import stat
 import tempfile
 import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
+from kudu.namerules import NameMapper
+from kudu.progress import format_size
 
-class NameRule:
-    def __init__(self, pattern, path):
-        if not isinstance(pattern, str):
-            pattern = os.path.join(*pattern)
-        self.pattern = re.compile(pattern)
+CHUNK_SIZE = 1 << 20
+SPOOL_SIZE = 8 << 20
+# archives up to this size are packaged in memory
+ARCHIVE_SPOOL_SIZE = 32 << 20
 
-        if not isinstance(path, str):
-            path = os.path.join(*path)
-        self.path = path
+# fixed member timestamps keep archives reproducible
+DATE_TIME = (1980, 1, 1, 0, 0, 0)
 
+# python 3.13 renamed ZipInfo._compresslevel
+LEVEL_ATTR = (
+    "compress_level" if hasattr(zipfile.ZipInfo, "compress_level") else "_compresslevel"
+)
+# ZipFile internals needed to add precompressed members
+RAW_WRITE_ATTRS = (
+    "_seekable",
+    "_writecheck",
+    "_didModify",
+    "start_dir",
+    "filelist",
+    "NameToInfo",
+)
 
-def mkztemp(base_name, root_dir=None, base_dir=None, name_rules=None):
-    save_cwd = os.getcwd()
 
-    if root_dir is not None:
-        os.chdir(root_dir)
+class _ChunkWriter:
+    # unseekable sink, makes zipfile write data descriptors
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class Spool:
+    # in memory up to max_size, then an unnamed temp file that is gone with
+    # the process even if it is killed
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.file = io.BytesIO()
+        if not max_size:
+            self.rollover()
+
+    @property
+    def rolled(self):
+        return not isinstance(self.file, io.BytesIO)
+
+    def rollover(self):
+        if self.rolled:
+            return
+        memory = self.file
+        self.file = tempfile.TemporaryFile(suffix=".zip")
+        with memory.getbuffer() as data:
+            self.file.write(data)
+        self.file.seek(memory.tell())
+        memory.close()
+
+    def getbuffer(self):
+        # None once the data is in the temp file
+        return None if self.rolled else self.file.getbuffer()
+
+    def write(self, data):
+        size = self.file.write(data)
+        if self.file.tell() > self.max_size:
+            self.rollover()
+        return size
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def walk_entries(base_name, root_dir=None, base_dir=None, name_rules=None):
+    if root_dir is None:
+        root_dir = os.curdir
 
     if base_dir is None:
         base_dir = os.curdir
 
+    top = os.path.normpath(os.path.join(root_dir, base_dir))
+    mapper = NameMapper(name_rules or [], base_name, cache_size=0)
+
+    for root, dirs, files in os.walk(top):
+        arcroot = os.path.relpath(root, root_dir)
+
+        if arcroot == os.curdir and ".kudu" in dirs:
+            dirs.remove(".kudu")
+
+        dirs.sort()
+        for name in sorted(files):
+            if arcroot == os.curdir:
+                arcname = name
+            else:
+                arcname = os.path.join(arcroot, name)
+
+            yield os.path.join(root, name), mapper.map(arcname)
+
+
+class CompressionPolicy:
+    store_extensions = (
+        # images
+        ".png", ".jpg", ".jpeg", ".gif", ".webp", ".heic",
+        # audio and video
+        ".mp4", ".m4v", ".mov", ".webm", ".mp3", ".m4a", ".aac",
+        # archives and fonts
+        ".zip", ".gz", ".bz2", ".xz", ".7z", ".woff", ".woff2",
+    )  # fmt: skip
+
+    def __init__(
+        self,
+        store=None,
+        deflate=None,
+        level=zlib.Z_DEFAULT_COMPRESSION,
+        probe_size=4096,
+        min_savings=0.1,
+    ):
+        if store is None:
+            store = self.store_extensions
+        self.store = frozenset(ext.lower() for ext in store)
+        self.deflate = frozenset(ext.lower() for ext in deflate or ())
+        self.level = level
+        self.probe_size = probe_size
+        self.min_savings = min_savings
+
+    def probe(self, filename):
+        with open(filename, "rb") as f:
+            data = f.read(self.probe_size)
+
+        if not data:
+            return True
+
+        compressed = zlib.compress(data, 1)
+        return len(compressed) <= len(data) * (1 - self.min_savings)
+
+    def choose(self, filename):
+        ext = os.path.splitext(filename)[1].lower()
+
+        if ext in self.deflate:
+            return zipfile.ZIP_DEFLATED, self.level
+        if ext in self.store:
+            return zipfile.ZIP_STORED, None
+        if self.probe_size and not self.probe(filename):
+            return zipfile.ZIP_STORED, None
+
+        return zipfile.ZIP_DEFLATED, self.level
+
+
+class PackageSummary:
+    def __init__(self):
+        self.stored = [0, 0, 0]
+        self.deflated = [0, 0, 0]
+        self.reused = 0
+
+    def add(self, zinfo, reused=False):
+        self.reused += reused
+        if zinfo.compress_type == zipfile.ZIP_STORED:
+            counts = self.stored
+        else:
+            counts = self.deflated
+        counts[0] += 1
+        counts[1] += zinfo.file_size
+        counts[2] += zinfo.compress_size
+
+    def __str__(self):
+        return "Stored %d files (%s), deflated %d files (%s to %s), reused %d" % (
+            self.stored[0],
+            format_size(self.stored[1]),
+            self.deflated[0],
+            format_size(self.deflated[1]),
+            format_size(self.deflated[2]),
+            self.reused,
+        )
+
+
+def _zipinfo(filename, arcname, policy, st):
+    zinfo = zipfile.ZipInfo(arcname, DATE_TIME)
+    mode = 0o755 if st.st_mode & 0o111 else 0o644
+    zinfo.external_attr = (stat.S_IFREG | mode) << 16
+    zinfo.file_size = st.st_size
+    compress_type, level = policy.choose(filename)
+    zinfo.compress_type = compress_type
+    setattr(zinfo, LEVEL_ATTR, level)
+    return zinfo
+
+
+def _compress(filename, arcname, policy, cache=None, chunk_size=CHUNK_SIZE):
+    st = os.stat(filename)
+    zinfo = _zipinfo(filename, arcname, policy, st)
+    level = getattr(zinfo, LEVEL_ATTR)
+
+    # stored members cost no cpu, caching them only doubles the disk use
+    if zinfo.compress_type != zipfile.ZIP_DEFLATED:
+        cache = None
+
+    if cache is not None:
+        cached = cache.get(filename, st, zinfo.compress_type, level)
+        if cached:
+            zinfo.CRC, raw = cached
+            zinfo.compress_size = os.fstat(raw.fileno()).st_size
+            return zinfo, raw, True
+
+    if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    else:
+        compressor = None
+
+    raw = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+    sha = hashlib.sha256() if cache is not None else None
+    crc = size = 0
+
+    with open(filename, "rb") as src:
+        while True:
+            chunk = src.read(chunk_size)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            if sha:
+                sha.update(chunk)
+            raw.write(compressor.compress(chunk) if compressor else chunk)
+
+    if compressor:
+        raw.write(compressor.flush())
+
+    zinfo.CRC = crc
+    zinfo.file_size = size
+    zinfo.compress_size = raw.tell()
+    raw.seek(0)
+
+    if cache is not None:
+        cache.put(
+            filename,
+            st,
+            sha.hexdigest(),
+            crc,
+            zinfo.compress_type,
+            level,
+            raw,
+        )
+
+    return zinfo, raw, False
+
+
+def _crc32(f, chunk_size=CHUNK_SIZE):
+    crc = 0
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return crc
+        crc = zlib.crc32(chunk, crc)
+
+
+def _imap_ordered(executor, fn, iterable, window):
+    pending = deque()
+
+    for args in iterable:
+        pending.append(executor.submit(fn, *args))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+
+def _raw_writes(zf):
+    return all(hasattr(zf, name) for name in RAW_WRITE_ATTRS)
+
+
+def _recompress(zf, zinfo, raw, chunk_size=CHUNK_SIZE):
+    # public api only, zipfile compresses the member again itself
+    if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+        decompressor = zlib.decompressobj(-15)
+    else:
+        decompressor = None
+
+    with zf.open(zinfo, "w") as dst:
+        while True:
+            chunk = raw.read(chunk_size)
+            if not chunk:
+                break
+            dst.write(decompressor.decompress(chunk) if decompressor else chunk)
+            yield
+
+
+def write_compressed(zf, zinfo, raw, chunk_size=CHUNK_SIZE):
+    if not _raw_writes(zf):
+        yield from _recompress(zf, zinfo, raw, chunk_size)
+        return
+
+    # same header layout ZipFile.write produces for a seekable file
+    zip64 = zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT
+
+    if zf._seekable:
+        zf.fp.seek(zf.start_dir)
+    zinfo.header_offset = zf.fp.tell()
+
+    zf._writecheck(zinfo)
+    zf._didModify = True
+
+    zf.fp.write(zinfo.FileHeader(zip64))
+    while True:
+        chunk = raw.read(chunk_size)
+        if not chunk:
+            break
+        zf.fp.write(chunk)
+        yield
+
+    zf.start_dir = zf.fp.tell()
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[zinfo.filename] = zinfo
+
+
+def _write_entries(
+    zf,
+    entries,
+    jobs=1,
+    policy=None,
+    summary=None,
+    cache=None,
+    chunk_size=CHUNK_SIZE,
+    progress=None,
+):
+    if not jobs:
+        jobs = os.cpu_count() or 1
+
+    if policy is None:
+        policy = CompressionPolicy()
+
+    if jobs == 1 and cache is None:
+        for filename, arcname in entries:
+            zinfo = _zipinfo(filename, arcname, policy, os.stat(filename))
+
+            if (
+                zinfo.compress_type == zipfile.ZIP_STORED
+                and _raw_writes(zf)
+                and not zf._seekable
+            ):
+                # readers cannot find the end of stored data without sizes
+                # in the local header, so no data descriptor for these
+                with open(filename, "rb") as src:
+                    zinfo.CRC = _crc32(src, chunk_size)
+                    zinfo.compress_size = zinfo.file_size = src.tell()
+                    src.seek(0)
+                    for _ in write_compressed(zf, zinfo, src, chunk_size):
+                        yield
+            else:
+                with open(filename, "rb") as src, zf.open(zinfo, "w") as dst:
+                    while True:
+                        chunk = src.read(chunk_size)
+                        if not chunk:
+                            break
+                        dst.write(chunk)
+                        yield
+
+            if summary is not None:
+                summary.add(zinfo)
+            if progress is not None:
+                progress.update(1, zinfo.file_size)
+        return
+
+    with ThreadPoolExecutor(jobs) as executor:
+        args = ((filename, arcname, policy, cache) for filename, arcname in entries)
+        members = _imap_ordered(executor, _compress, args, jobs * 2)
+
+        for zinfo, raw, reused in members:
+            with raw:
+                for _ in write_compressed(zf, zinfo, raw, chunk_size):
+                    yield
+
+            if summary is not None:
+                summary.add(zinfo, reused)
+            if progress is not None:
+                progress.update(1, zinfo.file_size)
+
+    if cache is not None:
+        cache.save()
+
+
+def _write_archive(
+    file,
+    base_name,
+    root_dir,
+    base_dir,
+    name_rules,
+    jobs,
+    policy,
+    summary,
+    cache,
+    progress,
+):
+    with zipfile.ZipFile(file, "w", zipfile.ZIP_DEFLATED) as zf:
+        entries = walk_entries(base_name, root_dir, base_dir, name_rules)
+        writer = _write_entries(
+            zf, entries, jobs, policy, summary, cache, progress=progress
+        )
+        for _ in writer:
+            pass
+
+
+def mkztemp(
+    base_name,
+    root_dir=None,
+    base_dir=None,
+    name_rules=None,
+    jobs=1,
+    policy=None,
+    summary=None,
+    cache=None,
+    progress=None,
+):
+    tmp_fd, tmp_name = tempfile.mkstemp(".zip")
+
     try:
-        tmp_fd, tmp_name = tempfile.mkstemp(".zip")
-        zf = zipfile.ZipFile(tmp_name, "w", zipfile.ZIP_DEFLATED)
-
-        for root, dirs, files in os.walk(base_dir):
-            arcroot = os.path.relpath(root)
-
-            for name in files:
-                if arcroot == os.curdir:
-                    arcname = name
-                else:
-                    arcname = os.path.join(arcroot, name)
-
-                if name_rules:
-                    for rule in name_rules:
-                        m = rule.pattern.match(arcname)
-                        if m:
-                            arcname = rule.path.format(*m.groups(), base_name=base_name)
-
-                filename = os.path.join(root, name)
-                zf.write(filename, arcname)
-    finally:
-        if root_dir is not None:
-            os.chdir(save_cwd)
+        _write_archive(
+            tmp_name,
+            base_name,
+            root_dir,
+            base_dir,
+            name_rules,
+            jobs,
+            policy,
+            summary,
+            cache,
+            progress,
+        )
+    except BaseException:
+        os.close(tmp_fd)
+        os.remove(tmp_name)
+        raise
 
     return tmp_fd, tmp_name
+
+
+def mkzspool(
+    base_name,
+    root_dir=None,
+    base_dir=None,
+    name_rules=None,
+    jobs=1,
+    policy=None,
+    summary=None,
+    cache=None,
+    progress=None,
+    max_size=ARCHIVE_SPOOL_SIZE,
+):
+    spool = Spool(max_size)
+    try:
+        _write_archive(
+            spool,
+            base_name,
+            root_dir,
+            base_dir,
+            name_rules,
+            jobs,
+            policy,
+            summary,
+            cache,
+            progress,
+        )
+    except BaseException:
+        spool.close()
+        raise
+
+    spool.seek(0)
+    return spool
+
+
+def mkzstream(
+    base_name,
+    root_dir=None,
+    base_dir=None,
+    name_rules=None,
+    jobs=1,
+    policy=None,
+    summary=None,
+    cache=None,
+    chunk_size=CHUNK_SIZE,
+    progress=None,
+):
+    sink = _ChunkWriter()
+
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED) as zf:
+        entries = walk_entries(base_name, root_dir, base_dir, name_rules)
+        writer = _write_entries(
+            zf, entries, jobs, policy, summary, cache, chunk_size, progress
+        )
+        for _ in writer:
+            data = sink.drain()
+            if data:
+                yield data
+
+    # central directory is written on close
+    yield sink.drain()
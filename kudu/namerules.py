@@ -0,0 +1,202 @@
+import os
+import re
+from functools import lru_cache, partial
+from string import Formatter
+
+CACHE_SIZE = 1 << 14
+
+# fnmatch compares normcased names, so link rules ignore case where it does
+FNMATCH_FLAGS = re.DOTALL | (re.IGNORECASE if os.path.normcase("A") == "a" else 0)
+
+SCOPED_FLAGS = {re.IGNORECASE: "i", re.MULTILINE: "m", re.DOTALL: "s", re.VERBOSE: "x"}
+BACKREFERENCE = re.compile(r"\\[1-9]|\(\?P=")
+
+
+class RuleConflict(ValueError):
+    pass
+
+
+class NameRule:
+    def __init__(self, pattern, path, flags=0):
+        if not isinstance(pattern, str):
+            pattern = os.path.join(*pattern)
+        self.pattern = re.compile(pattern, flags)
+
+        if not isinstance(path, str):
+            path = os.path.join(*path)
+        self.path = path
+
+        self.prefix = _literal_prefix(pattern)
+
+    def __repr__(self):
+        return "NameRule(%r, %r)" % (self.pattern.pattern, self.path)
+
+    def may_match(self, prefix):
+        # whether names below the directory prefix can start with the literal
+        # prefix of the pattern
+        n = min(len(self.prefix), len(prefix))
+        if self.pattern.flags & re.IGNORECASE:
+            return self.prefix[:n].lower() == prefix[:n].lower()
+        return self.prefix[:n] == prefix[:n]
+
+    def scoped(self):
+        flags = self.pattern.flags & ~re.UNICODE
+        letters = "".join(c for f, c in SCOPED_FLAGS.items() if flags & f)
+        if flags & ~sum(SCOPED_FLAGS) or BACKREFERENCE.search(self.pattern.pattern):
+            return None
+        return "(?%s:%s)" % (letters, self.pattern.pattern)
+
+
+def _literal_prefix(pattern):
+    if "|" in pattern:
+        return ""
+
+    prefix = []
+    i = 1 if pattern.startswith("^") else 0
+    while i < len(pattern):
+        c, step = pattern[i], 1
+        if c == "\\" and i + 1 < len(pattern) and not pattern[i + 1].isalnum():
+            c, step = pattern[i + 1], 2
+        elif c in ".^$*+?{}[]()|\\":
+            break
+        if pattern[i + step : i + step + 1] in ("*", "?", "{"):
+            break
+        prefix.append(c)
+        i += step
+    return "".join(prefix)
+
+
+def _sample(pattern):
+    # a name the pattern most likely matches, for simple patterns only
+    pattern = re.sub(r"^\^|(\$|\\Z)$", "", pattern)
+    pattern = re.sub(r"\((?:\?:)?\.[*+]\)", "x", pattern)
+    return re.sub(r"\\([^0-9A-Za-z])", r"\1", pattern)
+
+
+def check_rules(rules):
+    # a rule is unreachable when an earlier rule matches everything it would
+    for j, rule in enumerate(rules):
+        candidates = (
+            rule.prefix,
+            rule.prefix + "x",
+            rule.prefix + os.sep + "x",
+            _sample(rule.pattern.pattern),
+        )
+        probes = [probe for probe in candidates if rule.pattern.match(probe)]
+        for earlier in rules[:j]:
+            same = (earlier.pattern.pattern, earlier.pattern.flags) == (
+                rule.pattern.pattern,
+                rule.pattern.flags,
+            )
+            if same or probes and all(earlier.pattern.match(p) for p in probes):
+                raise RuleConflict("%r is shadowed by %r" % (rule, earlier))
+
+
+class NameMapper:
+    # renames with the first matching rule, all rules that may apply to a
+    # directory are tried in one match of a combined pattern
+    def __init__(self, rules, base_name, cache_size=CACHE_SIZE):
+        check_rules(rules)
+
+        self.rules = [
+            (rule, _bind_base_name(rule.path, base_name).format) for rule in rules
+        ]
+        self.combined = {}
+        self.prefixes = {}
+
+        if cache_size:
+            self.map = lru_cache(cache_size)(self.map)
+
+    def map(self, name):
+        dirname = name.rpartition(os.sep)[0]
+        try:
+            rename = self.prefixes[dirname]
+        except KeyError:
+            prefix = dirname + os.sep if dirname else ""
+            candidates = tuple(
+                i for i, (rule, _) in enumerate(self.rules) if rule.may_match(prefix)
+            )
+            rename = self.prefixes[dirname] = self._compile(candidates)
+        return rename(name)
+
+    def _compile(self, candidates):
+        try:
+            return self.combined[candidates]
+        except KeyError:
+            pass
+
+        rules = [self.rules[i] for i in candidates]
+        if not rules:
+            rename = _unchanged
+        elif len(rules) == 1:
+            rename = _single_match(*rules[0])
+        elif any(rule.scoped() is None for rule, _ in rules):
+            rename = partial(_first_match, rules)
+        else:
+            alternatives, groups, index = [], {}, 1
+            for rule, format_path in rules:
+                alternatives.append("(%s)" % rule.scoped())
+                groups[index] = (index, index + rule.pattern.groups, format_path)
+                index += 1 + rule.pattern.groups
+            match = re.compile("|".join(alternatives)).match
+            rename = partial(_combined_match, match, groups)
+
+        self.combined[candidates] = rename
+        return rename
+
+
+def _bind_base_name(path, base_name):
+    # substitutes base_name once, leaves the group fields to format
+    parts = []
+    for literal, field, spec, conversion in Formatter().parse(path):
+        parts.append(literal.replace("{", "{{").replace("}", "}}"))
+        if field == "base_name" and not spec and not conversion:
+            parts.append(base_name.replace("{", "{{").replace("}", "}}"))
+        elif field is not None:
+            parts.append(
+                "{%s%s%s}"
+                % (
+                    field,
+                    "!" + conversion if conversion else "",
+                    ":" + spec if spec else "",
+                )
+            )
+    return "".join(parts)
+
+
+def _unchanged(name):
+    return name
+
+
+def _single_match(rule, format_path):
+    match = rule.pattern.match
+
+    def rename(name):
+        m = match(name)
+        return format_path(*m.groups()) if m else name
+
+    return rename
+
+
+def _first_match(rules, name):
+    for rule, format_path in rules:
+        m = rule.pattern.match(name)
+        if m:
+            return format_path(*m.groups())
+    return name
+
+
+def _combined_match(match, groups, name):
+    m = match(name)
+    if m is None:
+        return name
+    start, end, format_path = groups[m.lastindex]
+    return format_path(*m.groups()[start:end])
+
+
+def relpath(path, top):
+    # paths from scandir and watchdog already start with top
+    prefix = os.path.join(top, "")
+    if path.startswith(prefix):
+        return path[len(prefix) :]
+    return os.path.relpath(path, top)
@@ -0,0 +1,126 @@
+import sys
+import threading
+import time
+
+import click
+
+# redraws per second on a terminal
+RATE = 4
+# seconds between summary lines in logs
+INTERVAL = 10
+
+
+def _isatty(stream):
+    try:
+        return stream.isatty()
+    except (AttributeError, ValueError):
+        return False
+
+
+def format_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            break
+        size /= 1024.0
+    return "%.1f %s" % (size, unit)
+
+
+def format_eta(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return "%d:%02d:%02d" % (hours, minutes, seconds)
+    return "%d:%02d" % (minutes, seconds)
+
+
+class Progress:
+    # thread safe counter of files and bytes, redrawn at most RATE times per
+    # second on a terminal and every INTERVAL seconds otherwise
+    def __init__(self, label, files=None, size=None, rate=RATE, interval=INTERVAL):
+        self.label = label
+        self.total_files = files
+        self.total_size = size
+        self.files = 0
+        self.size = 0
+        self.tty = _isatty(sys.stdout)
+        self.period = 1.0 / rate if self.tty else interval
+        self.start = self.last = time.time()
+        self.width = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.finish(exc_type is None)
+
+    def update(self, files=0, size=0):
+        with self.lock:
+            self.files += files
+            self.size += size
+
+            now = time.time()
+            if now - self.last < self.period:
+                return
+            self.last = now
+            self._draw(self.line(now))
+
+    def line(self, now=None):
+        elapsed = max((now or time.time()) - self.start, 1e-6)
+        speed = self.size / elapsed
+
+        parts = []
+        if self.total_files is not None:
+            parts.append("%d/%d files" % (self.files, self.total_files))
+        elif self.files or not self.size:
+            parts.append("%d files" % self.files)
+
+        if self.total_size:
+            parts.append(
+                "%s/%s" % (format_size(self.size), format_size(self.total_size))
+            )
+        elif self.size:
+            parts.append(format_size(self.size))
+
+        if self.size:
+            parts.append("%.1f MB/s" % (speed / 1048576.0))
+
+        remaining = None
+        if self.total_size and self.size:
+            remaining = (self.total_size - self.size) / speed
+        elif self.total_files and self.files:
+            remaining = (self.total_files - self.files) * elapsed / self.files
+        if remaining is not None:
+            parts.append("ETA %s" % format_eta(max(0, remaining)))
+
+        return "%s: %s" % (self.label, ", ".join(parts))
+
+    def _draw(self, line):
+        if self.tty:
+            click.echo("\r" + line.ljust(self.width), nl=False)
+            self.width = len(line)
+        else:
+            click.echo(line)
+
+    def finish(self, done=True):
+        with self.lock:
+            elapsed = time.time() - self.start
+            parts = []
+            if self.files or not self.size:
+                parts.append("%d files" % self.files)
+            if self.size:
+                parts.append(
+                    "%s in %.1fs (%.1f MB/s)"
+                    % (
+                        format_size(self.size),
+                        elapsed,
+                        self.size / 1048576.0 / max(elapsed, 1e-6),
+                    )
+                )
+            line = "%s: %s" % (self.label, ", ".join(parts))
+            line += ", done." if done else ", failed."
+
+            if self.tty:
+                click.echo("\r" + line.ljust(self.width))
+            else:
+                click.echo(line)
@@ -0,0 +1,88 @@
+import io
+import re
+
+from kudu.api import send
+
+BLOCK_SIZE = 1 << 20
+TAIL_SIZE = (1 << 16) + 22 + 20 + 56
+
+CONTENT_RANGE = re.compile(r"bytes (\d+)-(\d+)/(\d+)")
+
+
+class RangeNotSupported(Exception):
+    def __init__(self, response):
+        super(RangeNotSupported, self).__init__("Range requests not supported")
+        self.response = response
+
+
+class HTTPRangeFile(io.RawIOBase):
+    # read-only file over a url, fetched in ranges as zipfile seeks around
+    def __init__(self, url, block_size=BLOCK_SIZE):
+        self.url = url
+        self.block_size = block_size
+        self.position = 0
+        self.limit = None
+        self.bytes_fetched = 0
+        self.requests = 0
+
+        res = send("get", url, headers={"Range": "bytes=-%d" % TAIL_SIZE}, stream=True)
+        m = CONTENT_RANGE.match(res.headers.get("Content-Range", ""))
+        if res.status_code != 206 or not m:
+            raise RangeNotSupported(res)
+
+        self.size = int(m.group(3))
+        self.window_start = int(m.group(1))
+        self.window = res.content
+        self.bytes_fetched += len(self.window)
+        self.requests += 1
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+
+    def fetch(self, start, end):
+        res = send("get", self.url, headers={"Range": "bytes=%d-%d" % (start, end)})
+        if res.status_code != 206:
+            raise RangeNotSupported(res)
+
+        self.window_start = start
+        self.window = res.content
+        self.bytes_fetched += len(self.window)
+        self.requests += 1
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.position
+        size = min(size, self.size - self.position)
+        if size <= 0:
+            return b""
+
+        start = self.position - self.window_start
+        if start < 0 or start + size > len(self.window):
+            end = self.position + max(size, self.block_size)
+            if self.limit is not None:
+                end = min(end, max(self.limit, self.position + size))
+            self.fetch(self.position, min(end, self.size) - 1)
+            start = 0
+
+        data = self.window[start : start + size]
+        self.position += len(data)
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[: len(data)] = data
+        return len(data)
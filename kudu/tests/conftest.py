@@ -0,0 +1,22 @@
+import os
+
+import pytest
+
+from kudu.mkztemp import mkztemp
+
+
+@pytest.fixture
+def ztemp():
+    # mkztemp leaves closing and removing the archive to the caller
+    archives = []
+
+    def package(*args, **kwargs):
+        fd, name = mkztemp(*args, **kwargs)
+        archives.append((fd, name))
+        return fd, name
+
+    yield package
+
+    for fd, name in archives:
+        os.close(fd)
+        os.remove(name)
@@ -0,0 +1,109 @@
+import hashlib
+import re
+import xml.etree.ElementTree as ET
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RANGE = re.compile(r"bytes=(\d*)-(\d*)")
+
+
+class ObjectHandler(BaseHTTPRequestHandler):
+    # serves server.objects by path, with single range support and
+    # S3 style multipart uploads of <key>/<part number> + POST <key>
+    def log_message(self, *args):
+        pass
+
+    def _respond(self, status, headers=None, body=b""):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_PUT(self):
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.requests.append(("PUT", self.path, None))
+
+        # presigned urls carry their signature in the query
+        path = self.path.split("?")[0]
+        if path in self.server.failing:
+            self._respond(500)
+            return
+
+        self.server.objects[path] = data
+        self._respond(200, {"ETag": '"%s"' % hashlib.md5(data).hexdigest()})
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.requests.append(("POST", self.path, None))
+
+        path = self.path.split("?")[0]
+        parts = []
+        for part in ET.fromstring(data).iter("Part"):
+            name = "%s/%s" % (path, part.find("PartNumber").text)
+            body = self.server.objects.get(name)
+            etag = '"%s"' % hashlib.md5(body or b"").hexdigest()
+            if body is None or part.find("ETag").text != etag:
+                self._respond(400)
+                return
+            parts.append(body)
+
+        self.server.objects[path] = b"".join(parts)
+        self._respond(200)
+
+    def do_GET(self):
+        data = self.server.objects.get(self.path.split("?")[0])
+        self.server.requests.append(("GET", self.path, self.headers.get("Range")))
+
+        if data is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+
+        if self.headers.get("If-None-Match") == etag:
+            self._respond(304, {"ETag": etag})
+            return
+
+        m = RANGE.match(self.headers.get("Range") or "")
+        if m and self.server.ranges:
+            first, last = m.groups()
+            if not first:
+                first, last = max(0, len(data) - int(last)), len(data) - 1
+            else:
+                first = int(first)
+                last = min(int(last), len(data) - 1) if last else len(data) - 1
+
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", "bytes %d-%d/%d" % (first, last, len(data))
+            )
+            data = data[first : last + 1]
+        else:
+            self.send_response(200)
+
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+@contextmanager
+def serve(objects, ranges=True, handler=ObjectHandler):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.objects = objects
+    server.ranges = ranges
+    server.requests = []
+    server.failing = set()
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server, "http://127.0.0.1:%d" % server.server_address[1]
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,124 @@
+import json
+import os
+
+import click
+import pytest
+
+from kudu import api
+from kudu.tests.httpserver import ObjectHandler, serve
+
+
+def test_shared_session():
+    assert api.get_session() is api.get_session()
+
+
+def test_configure():
+    defaults = dict(api.http_options)
+    try:
+        api.configure(pool_size=4, retries=5)
+        adapter = api.get_session().get_adapter(api.api_url)
+        assert adapter._pool_maxsize == 4
+        assert adapter.max_retries.total == 5
+        assert "POST" not in adapter.max_retries.allowed_methods
+
+        # generator bodies cannot be sent a second time
+        adapter = api.get_session(retry=False).get_adapter(api.api_url)
+        assert adapter.max_retries.total == 0
+
+        with pytest.raises(click.UsageError, match="pool_sise"):
+            api.configure(pool_sise=4)
+    finally:
+        api.configure(**defaults)
+
+
+def test_file_cache(monkeypatch, tmp_path):
+    monkeypatch.setenv("KUDU_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(api, "_files", {})
+
+    objects = {"/files/7/": json.dumps({"id": 7, "metadata": {}}).encode()}
+    with serve(objects) as (server, url):
+        monkeypatch.setattr(api, "api_url", url)
+
+        assert api.get_file(7)["id"] == 7
+        api.get_file(7)["metadata"]["changed"] = True
+        assert api.get_file(7) == {"id": 7, "metadata": {}}
+        assert len(server.requests) == 1
+
+        # a later run revalidates the stored record
+        api._files.clear()
+        assert api.get_file(7)["id"] == 7
+        assert len(server.requests) == 2
+        assert api.get_file(7)["id"] == 7
+        assert len(server.requests) == 2
+
+        # and sees changes made elsewhere
+        objects["/files/7/"] = json.dumps({"id": 7, "metadata": {"b": 2}}).encode()
+        api._files.clear()
+        assert api.get_file(7)["metadata"] == {"b": 2}
+
+        objects["/files/7/"] = json.dumps({"id": 7, "metadata": {"a": 1}}).encode()
+        api.invalidate_file(7)
+        assert api.get_file(7)["metadata"] == {"a": 1}
+        assert api.get_file(8) is None
+
+        # other users and apis never see the stored record
+        api._files.clear()
+        monkeypatch.setitem(api.file_cache_options, "ttl", 60)
+        assert api.get_file(7, token="a")["id"] == 7
+        count = len(server.requests)
+        api._files.clear()
+        assert api.get_file(7, token="a")["id"] == 7
+        assert len(server.requests) == count
+        api._files.clear()
+        assert api.get_file(7, token="b")["id"] == 7
+        assert len(server.requests) == count + 1
+        path = api._file_cache_path(7, "a")
+        assert path != api._file_cache_path(7, "b")
+        monkeypatch.setattr(api, "api_url", "https://example.com")
+        assert path != api._file_cache_path(7, "a")
+        monkeypatch.setattr(api, "api_url", url)
+
+        with pytest.raises(click.UsageError, match="tll"):
+            api.configure_file_cache(tll=0)
+
+        api.invalidate_file(7)
+        assert not os.listdir(os.path.join(str(tmp_path), "files"))
+
+
+class AuthHandler(ObjectHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.requests.append(("POST", self.path, None))
+        self.server.token = "token%d" % len(self.server.requests)
+        self._respond(200, body=json.dumps({"token": self.server.token}).encode())
+
+    def do_GET(self):
+        if self.headers.get("Authorization") != "Token %s" % self.server.token:
+            self.server.requests.append(("GET", self.path, None))
+            self._respond(401)
+            return
+        super(AuthHandler, self).do_GET()
+
+
+def test_token_cache(monkeypatch, tmp_path):
+    monkeypatch.setenv("KUDU_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(api, "_credentials", {})
+    monkeypatch.setattr(api, "_renewed_tokens", {})
+
+    with serve({"/files/1/": b"{}"}, handler=AuthHandler) as (server, url):
+        monkeypatch.setattr(api, "api_url", url)
+        server.token = None
+
+        token = api.authenticate("user", "secret")
+        assert api.authenticate("user", "secret") == token
+        assert len(server.requests) == 1
+        assert os.stat(tmp_path / "tokens.json").st_mode & 0o777 == 0o600
+
+        # an expired token is replaced once and the request repeated
+        server.token = "expired"
+        assert api.request("get", "/files/1/", token=token).status_code == 200
+        assert api.request("get", "/files/1/", token=token).status_code == 200
+        assert [r[0] for r in server.requests] == ["POST", "GET", "POST", "GET", "GET"]
+
+        api.forget_token("user")
+        assert api.authenticate("user", "secret") != token
@@ -0,0 +1,114 @@
+import io
+from os import mkdir
+from zipfile import ZipFile
+
+import click
+import pytest
+from click.testing import CliRunner
+
+from kudu import api
+from kudu import types as types_module
+from kudu.commands import push as push_module
+from kudu.commands.deploy import deploy, load_deploy_manifest
+from kudu.config import write_config
+from kudu.tests.httpserver import serve
+
+
+class _Json:
+    def __init__(self, data, status_code=200):
+        self.data = data
+        self.status_code = status_code
+
+    def json(self):
+        return self.data
+
+
+def test_load_deploy_manifest():
+    runner = CliRunner()
+
+    with runner.isolated_filesystem():
+        write_config(
+            {
+                "files": [
+                    {"id": 519655, "path": "slides"},
+                    {
+                        "create": {"instance": 1, "body": "Test", "extension": "zip"},
+                        "path": "interface",
+                    },
+                ]
+            },
+            "deploy.yml",
+        )
+        entries = load_deploy_manifest("deploy.yml")
+        assert [e["path"] for e in entries] == ["slides", "interface"]
+
+        write_config({"files": [{"id": 519655}]}, "deploy.yml")
+        with pytest.raises(click.BadParameter):
+            load_deploy_manifest("deploy.yml")
+
+        write_config(
+            {"files": [{"id": 519655, "create": {}, "path": "slides"}]}, "deploy.yml"
+        )
+        with pytest.raises(click.BadParameter):
+            load_deploy_manifest("deploy.yml")
+
+
+def test_deploy(monkeypatch, tmp_path):
+    monkeypatch.setenv("KUDU_CACHE_DIR", str(tmp_path / "cache"))
+    records = {
+        file_id: {"id": file_id, "filename": "%d.zip" % file_id, "category": "zip"}
+        for file_id in (1, 2, 3)
+    }
+
+    def get_file(file_id, token=None):
+        return dict(records[file_id])
+
+    monkeypatch.setattr(types_module, "get_file", get_file)
+    monkeypatch.setattr(push_module, "get_file", get_file)
+    defaults = dict(api.http_options)
+    api.configure(retries=0)
+
+    runner = CliRunner()
+    try:
+        with runner.isolated_filesystem(), serve({}) as (server, url):
+            patched = []
+
+            def api_request(method, path, token=None, params=None, json=None):
+                file_id = int(path.split("/")[2])
+                if method == "patch":
+                    patched.append(file_id)
+                    return _Json({}, 200)
+                return _Json("%s/%d.zip" % (url, file_id))
+
+            monkeypatch.setattr(push_module, "api_request", api_request)
+            server.failing.add("/2.zip")
+
+            for file_id in records:
+                mkdir("app%d" % file_id)
+                with open("app%d/index.html" % file_id, "w") as f:
+                    f.write("<p>%d</p>" % file_id)
+            write_config(
+                {"files": [{"id": i, "path": "app%d" % i} for i in records]},
+                "deploy.yml",
+            )
+
+            result = runner.invoke(
+                deploy, ["deploy.yml", "--jobs", "2"], obj={"token": None}
+            )
+            assert result.exit_code == 1
+
+            # the table follows whatever the uploads printed
+            lines = result.output.splitlines()
+            table = lines[lines.index(next(l for l in lines if l.startswith("FILE"))) :]
+            rows = {int(line.split()[0]): line for line in table[1:]}
+            assert rows[1].endswith("pushed")
+            assert rows[2].endswith("failed: Upload failed with status 500")
+            assert rows[3].endswith("pushed")
+
+            assert sorted(patched) == [1, 3]
+            assert sorted(server.objects) == ["/1.zip", "/3.zip"]
+            for path in server.objects:
+                with ZipFile(io.BytesIO(server.objects[path])) as zf:
+                    assert zf.testzip() is None
+    finally:
+        api.configure(**defaults)
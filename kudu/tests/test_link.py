@@ -1,12 +1,18 @@
+import errno
 import os
 import shutil
+import stat
 import tempfile
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from os import getcwd, mkdir
+from os.path import join
 
 from click.testing import CliRunner
 from watchdog import events
 
+from kudu import filecopy
 from kudu.commands import link
 
 
@@ -73,3 +79,207 @@ def test_copy_files_event_handler():
         assert os.path.exists(os.path.join(dst, "slides", "1234_4321", "index.html"))
 
     shutil.rmtree(dst)
+
+
+def test_incremental_copyfiles():
+    dst = os.path.join(tempfile.gettempdir(), str(time.time()))
+    mkdir(dst)
+
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        src = getcwd()
+        converter = link.PresentationPathConverter({"filename": "1234_4321.zip"})
+
+        open("index.html", "wb").close()
+        mkdir("css")
+        with open(os.path.join("css", "main.css"), "w") as f:
+            f.write("body {}")
+        # kudu's own folder is never linked
+        os.makedirs(os.path.join(".kudu", "cache"))
+        open(os.path.join(".kudu", "cache", "index.json"), "w").close()
+
+        assert link.copyfiles(src, dst, converter) == (2, 0, 0)
+        assert not os.path.exists(os.path.join(dst, "slides", "1234_4321", ".kudu"))
+        assert link.copyfiles(src, dst, converter) == (0, 2, 0)
+
+        with open(os.path.join("css", "main.css"), "w") as f:
+            f.write("body { margin: 0 }")
+        orphan = os.path.join(dst, "slides", "1234_4321", "old.html")
+        open(orphan, "wb").close()
+
+        assert link.copyfiles(src, dst, converter, delete=True) == (1, 1, 1)
+        assert not os.path.exists(orphan)
+        with open(os.path.join(dst, "slides", "1234_4321", "css", "main.css")) as f:
+            assert f.read() == "body { margin: 0 }"
+
+        assert link.copyfiles(src, dst, converter, checksum=True) == (0, 2, 0)
+
+    shutil.rmtree(dst)
+
+
+def test_event_queue_coalesces_changes():
+    dst = os.path.join(tempfile.gettempdir(), str(time.time()))
+    mkdir(dst)
+
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        src = getcwd()
+        converter = link.PresentationPathConverter({"filename": "1234_4321.zip"})
+        event_handler = link.CopyFilesEventHandler(src, dst, converter)
+        queue = link.EventQueue(event_handler, quiet=0.1)
+        event_handler.queue = queue
+
+        copies = []
+        apply = event_handler.apply
+        event_handler.apply = lambda change: copies.append(change) or apply(change)
+
+        # editors save through a temporary file that is renamed over the original
+        with open("index.html~", "w") as f:
+            f.write("<html></html>")
+        event_handler.on_any_event(
+            events.FileCreatedEvent(os.path.join(src, "index.html~"))
+        )
+        event_handler.on_any_event(
+            events.FileModifiedEvent(os.path.join(src, "index.html~"))
+        )
+        os.rename("index.html~", "index.html")
+        event_handler.on_any_event(
+            events.FileMovedEvent(
+                os.path.join(src, "index.html~"), os.path.join(src, "index.html")
+            )
+        )
+        event_handler.on_any_event(
+            events.FileModifiedEvent(os.path.join(src, "index.html"))
+        )
+
+        queue.start()
+        time.sleep(0.5)
+
+        dst_path = os.path.join(dst, "slides", "1234_4321", "index.html")
+        with open(dst_path) as f:
+            assert f.read() == "<html></html>"
+        assert [c[0] for c in copies] == [link.DELETE, link.COPY]
+
+        os.remove("index.html")
+        event_handler.on_any_event(
+            events.FileDeletedEvent(os.path.join(src, "index.html"))
+        )
+        queue.stop()
+
+        assert not os.path.exists(dst_path)
+
+    shutil.rmtree(dst)
+
+
+def test_event_queue_renames():
+    dst = os.path.join(tempfile.gettempdir(), str(time.time()))
+    mkdir(dst)
+
+    runner = CliRunner()
+    with runner.isolated_filesystem(), ThreadPoolExecutor(2) as executor:
+        src = getcwd()
+        converter = link.PresentationPathConverter({"filename": "1234_4321.zip"})
+        event_handler = link.CopyFilesEventHandler(src, dst, converter)
+        queue = link.EventQueue(event_handler)
+
+        def write(name, content):
+            with open(name, "w") as f:
+                f.write(content)
+
+        def read(name):
+            with open(os.path.join(dst, "slides", "1234_4321", name)) as f:
+                return f.read()
+
+        def flush(*changes):
+            for action, path, old_path in changes:
+                queue.put((action, join(src, path), old_path and join(src, old_path)))
+            batch, queue.pending = list(queue.pending.values()), OrderedDict()
+            queue.flush(batch, executor)
+
+        write("a.html", "a")
+        write("b.html", "b")
+        flush((link.COPY, "a.html", None), (link.COPY, "b.html", None))
+
+        # a file edited after its rename gets the new content
+        os.rename("a.html", "c.html")
+        write("c.html", "c")
+        flush((link.MOVE, "c.html", "a.html"), (link.COPY, "c.html", None))
+        assert read("c.html") == "c"
+        assert not os.path.exists(os.path.join(dst, "slides", "1234_4321", "a.html"))
+
+        # swapping two files through a temp name
+        os.rename("b.html", "tmp.html")
+        os.rename("c.html", "b.html")
+        os.rename("tmp.html", "c.html")
+        flush(
+            (link.MOVE, "tmp.html", "b.html"),
+            (link.MOVE, "b.html", "c.html"),
+            (link.MOVE, "c.html", "tmp.html"),
+        )
+        assert read("b.html") == "c"
+        assert read("c.html") == "b"
+
+    shutil.rmtree(dst)
+
+
+def test_link_modes(monkeypatch):
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        with open("video.mp4", "wb") as f:
+            f.write(os.urandom(1 << 16))
+
+        assert filecopy.place_file("video.mp4", "copy/video.mp4") == "copy"
+        assert filecopy.place_file("video.mp4", "auto/video.mp4", "auto") in (
+            "reflink",
+            "copy_range",
+            "copy",
+        )
+        assert filecopy.place_file("video.mp4", "link/video.mp4", "hardlink") == (
+            "hardlink"
+        )
+        assert os.path.samefile("video.mp4", "link/video.mp4")
+
+        for path in ("copy/video.mp4", "auto/video.mp4"):
+            assert not os.path.samefile("video.mp4", path)
+            assert stat.S_IMODE(os.stat(path).st_mode) == (
+                stat.S_IMODE(os.stat("video.mp4").st_mode)
+            )
+            with open("video.mp4", "rb") as a, open(path, "rb") as b:
+                assert a.read() == b.read()
+
+        def cross_device(src, dst):
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+        monkeypatch.setattr(os, "link", cross_device)
+        filecopy._unsupported.clear()
+        assert filecopy.place_file("video.mp4", "link/video.mp4", "hardlink") == (
+            "copy"
+        )
+        assert not os.path.samefile("video.mp4", "link/video.mp4")
+        assert os.listdir("link") == ["video.mp4"]
+
+
+def test_path_converter_rules():
+    pfile = {"filename": "1234_4321.zip"}
+
+    presentation = link.PresentationPathConverter(pfile)
+    for relpath, expected in [
+        ("index.html", ("slides", "1234_4321", "index.html")),
+        ("thumbnail.png", ("slides", "1234_4321", "1234_4321.png")),
+        (join("css", "thumbnail.png"), ("slides", "1234_4321", "css", "thumbnail.png")),
+        # nested iPadOnly files are flattened to their name
+        (join("iPadOnly", "a", "iPad.html"), ("slides", "1234_4321", "iPad.html")),
+        (join("iPadOnly", "thumbnail.png"), ("slides", "1234_4321", "1234_4321.png")),
+    ]:
+        assert presentation.convert(relpath) == join(*expected)
+
+    interactive = link.InteractivePathConverter(pfile)
+    assert interactive.convert(join("iPadOnly", "x.html")) == join(
+        "zip", "1234_4321", "iPadOnly", "x.html"
+    )
+
+    interface = link.InterfacePathConverter(pfile)
+    assert interface.convert(join("interface", "a", "b.js")) == join(
+        "1234_4321", "b.js"
+    )
+    assert interface.convert(join("interfaces", "b.js")) == join("interfaces", "b.js")
@@ -0,0 +1,94 @@
+import json
+import subprocess
+import sys
+
+from click.testing import CliRunner
+
+from kudu import api, trace
+from kudu.__main__ import COMMANDS, cli
+
+# microseconds python -X importtime may spend on importing kudu.__main__
+STARTUP_BUDGET = 250000
+
+HEAVY_MODULES = ("requests", "urllib3", "yaml", "watchdog", "zipfile")
+
+SCRIPT = """
+import sys
+before = set(sys.modules)
+import kudu.__main__
+print(" ".join(sorted(set(sys.modules) - before)))
+"""
+
+
+def test_lazy_commands():
+    assert cli.list_commands(None) == sorted(COMMANDS)
+    assert cli.get_command(None, "push").name == "push"
+    assert cli.get_command(None, "missing") is None
+
+
+def test_startup_imports():
+    res = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", SCRIPT],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    imported = res.stdout.split()
+    for name in HEAVY_MODULES:
+        assert name not in imported
+
+    cumulative = [
+        int(line.split("|")[1])
+        for line in res.stderr.splitlines()
+        if line.split("|")[-1].strip() == "kudu.__main__"
+    ]
+    assert cumulative and cumulative[0] < STARTUP_BUDGET
+
+
+def test_logout(monkeypatch, tmp_path):
+    monkeypatch.setenv("KUDU_CACHE_DIR", str(tmp_path))
+    api.save_token("user", "secret-token")
+
+    result = CliRunner().invoke(cli, ["-u", "user", "-p", "password", "logout"])
+    assert result.exit_code == 0
+    assert "secret-token" not in (tmp_path / "tokens.json").read_text()
+
+    api.save_token("user", "secret-token")
+    result = CliRunner().invoke(cli, ["logout"], input="user\n")
+    assert result.exit_code == 0
+    assert "Username" in result.output and "Password" not in result.output
+    assert "secret-token" not in (tmp_path / "tokens.json").read_text()
+
+    api.save_token("user", "secret-token")
+    result = CliRunner().invoke(cli, ["logout", "--all"], input="")
+    assert result.exit_code == 0
+    assert "Username" not in result.output and "Password" not in result.output
+    assert "secret-token" not in (tmp_path / "tokens.json").read_text()
+
+
+def test_profile(monkeypatch, tmp_path):
+    monkeypatch.setenv("KUDU_CACHE_DIR", str(tmp_path))
+    path = str(tmp_path / "trace.json")
+
+    result = CliRunner().invoke(
+        cli, ["-u", "user", "-p", "password", "--profile", path, "logout"]
+    )
+    assert result.exit_code == 0
+    assert not trace.enabled()
+    with open(path) as f:
+        assert [e["name"] for e in json.load(f)["traceEvents"]] == ["kudu logout"]
+
+    trace.start(path)
+    with trace.span("outer", files=2) as args:
+        with trace.span("inner"):
+            args["bytes"] = 10
+    trace.save()
+
+    with open(path) as f:
+        events = {e["name"]: e for e in json.load(f)["traceEvents"]}
+
+    assert events["outer"]["ph"] == "X"
+    assert events["outer"]["args"] == {"files": 2, "bytes": 10}
+    assert events["outer"]["ts"] <= events["inner"]["ts"]
+    assert events["inner"]["dur"] <= events["outer"]["dur"]
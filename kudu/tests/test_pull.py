@@ -1,10 +1,30 @@
+import functools
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+from os import mkdir
 from os.path import exists, join
-from zipfile import ZipFile
+from zipfile import BadZipFile, ZipFile
 
+import click
+import pytest
+import requests
 from click.testing import CliRunner
 
+from kudu import api, archivecache
 from kudu.__main__ import cli
+from kudu.commands import pull as pull_module
+from kudu.commands.pull import member_mapper, pull, sync_dir, to_dir, unpack_url
+from kudu.commands.push import CATEGORY_RULES
 from kudu.config import write_config
+from kudu.download import DownloadError, download
+from kudu.mkztemp import mkzstream
+from kudu.tests.httpserver import ObjectHandler, serve
+from kudu.zipstream import extract_stream
 
 
 def test_interface():
@@ -46,3 +66,331 @@ def test_zip_path():
 
         zip_file = ZipFile("test.zip")
         assert zip_file.testzip() is None
+
+
+def test_extract_stream(ztemp):
+    runner = CliRunner()
+
+    with runner.isolated_filesystem():
+        mkdir("src")
+        mkdir(join("src", "folder"))
+        with open(join("src", "index.html"), "w") as f:
+            f.write("<html></html>" * 100)
+        with open(join("src", "folder", "foobar.json"), "w") as f:
+            f.write("{}")
+        open(join("src", "thumbnail.png"), "w").close()
+
+        rules = [r.rule for r in CATEGORY_RULES if "zip" in r.category]
+        streamed = b"".join(mkzstream("test", root_dir="src", name_rules=rules))
+        _, name = ztemp("test", root_dir="src", name_rules=rules)
+
+        for data in (streamed, open(name, "rb").read()):
+            with tempfile.TemporaryDirectory() as dst:
+                extract_stream(io.BytesIO(data), dst, member_mapper("test", "zip"))
+                assert exists(join(dst, "index.html"))
+                assert exists(join(dst, "thumbnail.png"))
+                assert exists(join(dst, "folder", "foobar.json"))
+
+                with open(join(dst, "index.html")) as f:
+                    assert f.read() == "<html></html>" * 100
+
+        with tempfile.TemporaryDirectory() as dst:
+            extract_stream(io.BytesIO(streamed), dst, member_mapper("test", ""))
+            assert exists(join(dst, "interface", "index.html"))
+
+
+def test_sync(ztemp):
+    runner = CliRunner()
+
+    with runner.isolated_filesystem():
+        mkdir("src")
+        for i in range(5):
+            with open(join("src", "%d.html" % i), "wb") as f:
+                f.write(os.urandom(50000))
+        open(join("src", "thumbnail.png"), "w").close()
+
+        rules = [r.rule for r in CATEGORY_RULES if "zip" in r.category]
+        _, name = ztemp("test", root_dir="src", name_rules=rules)
+        with open(name, "rb") as f:
+            objects = {"/test.zip": f.read()}
+
+        mkdir("dst")
+        for i in range(4):
+            shutil.copy(join("src", "%d.html" % i), join("dst", "%d.html" % i))
+        with open(join("dst", "0.html"), "wb") as f:
+            f.write(b"outdated")
+
+        with serve(objects) as (server, url):
+            sync_dir(url + "/test.zip", "dst", "test", "zip")
+
+            fetched = [r for r in server.requests if r[2]]
+            assert len(fetched) == len(server.requests)
+
+        for name in ("0.html", "4.html", "thumbnail.png"):
+            assert exists(join("dst", name))
+        for i in range(5):
+            with open(join("src", "%d.html" % i), "rb") as a:
+                with open(join("dst", "%d.html" % i), "rb") as b:
+                    assert a.read() == b.read()
+
+        with serve(objects, ranges=False) as (server, url):
+            sync_dir(url + "/test.zip", "full", "test", "zip")
+            assert exists(join("full", "3.html"))
+
+
+def test_download():
+    runner = CliRunner()
+    data = os.urandom(100000)
+
+    with runner.isolated_filesystem():
+        with serve({"/test.bin": data}) as (server, url):
+            download(url + "/test.bin", "test.bin", connections=4, segment_size=16384)
+            assert len(server.requests) == 7
+
+            # resume with the first three segments already downloaded
+            with open("partial.bin", "wb") as f:
+                f.write(data[: 3 * 16384])
+                f.truncate(len(data))
+            with open("partial.bin.kudu-download", "w") as f:
+                json.dump(
+                    {
+                        "size": len(data),
+                        "etag": '"%s"' % hashlib.md5(data).hexdigest(),
+                        "done": [0, 16384, 32768],
+                    },
+                    f,
+                )
+
+            del server.requests[:]
+            download(url + "/test.bin", "partial.bin", segment_size=16384)
+            assert len(server.requests) == 5
+
+        for name in ("test.bin", "partial.bin"):
+            with open(name, "rb") as f:
+                assert f.read() == data
+        assert not exists("partial.bin.kudu-download")
+
+
+class _DownloadUrl:
+    def __init__(self, url):
+        self.url = url
+
+    def json(self):
+        return self.url
+
+
+class _Response:
+    def __init__(self, status_code, body, size):
+        self.status_code = status_code
+        self.raw = io.BytesIO(body)
+        self.headers = {"Content-Length": str(size)}
+
+
+def test_archive_cache(monkeypatch, tmp_path, ztemp):
+    monkeypatch.setenv("KUDU_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.chdir(tmp_path)
+
+    mkdir("src")
+    with open(join("src", "index.html"), "wb") as f:
+        f.write(os.urandom(50000))
+    open(join("src", "thumbnail.png"), "w").close()
+
+    rules = [r.rule for r in CATEGORY_RULES if "zip" in r.category]
+    _, name = ztemp("test", root_dir="src", name_rules=rules)
+    with open(name, "rb") as f:
+        objects = {"/test.zip": f.read()}
+
+    pf = {
+        "id": 1,
+        "filename": "test.zip",
+        "category": "zip",
+        "creationTime": "2020-01-01T00:00:00",
+    }
+
+    with serve(objects) as (server, url):
+        urls = []
+
+        def api_request(method, path, token=None):
+            urls.append(path)
+            return _DownloadUrl(url + "/test.zip")
+
+        monkeypatch.setattr(pull_module, "api_request", api_request)
+        ctx = click.Context(pull, obj={"token": None})
+
+        for dst in ("first", "second"):
+            mkdir(dst)
+            ctx.invoke(pull, pf=pf, path=dst)
+            with open(join(dst, "index.html"), "rb") as a:
+                with open(join("src", "index.html"), "rb") as b:
+                    assert a.read() == b.read()
+            assert exists(join(dst, "thumbnail.png"))
+
+        # the second pull neither asks the api nor downloads
+        assert len(urls) == 1
+        assert len(server.requests) == 1
+
+        ctx.invoke(pull, pf=pf, path="copy.zip")
+        with open("copy.zip", "rb") as f:
+            assert f.read() == objects["/test.zip"]
+        assert len(server.requests) == 1
+
+        # a new push changes the version
+        pf["creationTime"] = "2020-01-02T00:00:00"
+        ctx.invoke(pull, pf=pf, path="second")
+        assert len(server.requests) == 2
+
+        # a corrupt entry is dropped and the archive downloaded again
+        cached = archivecache.lookup(archivecache.archive_key(pf))
+        with open(cached, "wb") as f:
+            f.write(b"<Error><Code>AccessDenied</Code></Error>")
+        ctx.invoke(pull, pf=pf, path="second")
+        assert len(server.requests) == 3
+        with open(cached, "rb") as f:
+            assert f.read() == objects["/test.zip"]
+
+    cached = os.listdir(str(tmp_path / "cache" / "archives"))
+    assert len(cached) == 2
+    archivecache.prune(len(objects["/test.zip"]))
+    assert len(os.listdir(str(tmp_path / "cache" / "archives"))) == 1
+
+    # only complete archives of successful responses are committed
+    data = objects["/test.zip"]
+    for status, body, size in (
+        (403, data, len(data)),
+        (200, data[:-10], len(data)),
+        (200, b"<html></html>", 13),
+    ):
+        res = _Response(status, body, size)
+        with archivecache.caching(res, "error.zip") as fp:
+            fp.read(10)
+        assert archivecache.lookup("error.zip") is None
+
+    with archivecache.caching(_Response(200, data, len(data)), "ok.zip") as fp:
+        fp.read(10)
+    assert archivecache.lookup("ok.zip")
+
+    with pytest.raises(click.UsageError, match="max_sise"):
+        archivecache.configure(max_sise=0)
+
+
+class ForbiddenHandler(ObjectHandler):
+    def do_GET(self):
+        self.server.requests.append(("GET", self.path, self.headers.get("Range")))
+        self._respond(403, body=b"<Error><Code>AccessDenied</Code></Error>")
+
+
+def test_error_responses(tmp_path):
+    with pytest.raises(BadZipFile):
+        extract_stream(io.BytesIO(b"<Error><Code>AccessDenied</Code></Error>"), "x")
+
+    with serve({}, handler=ForbiddenHandler) as (server, url):
+        with pytest.raises(requests.HTTPError):
+            to_dir(url + "/test.zip", str(tmp_path), "test", "zip")
+        with pytest.raises(requests.HTTPError):
+            sync_dir(url + "/test.zip", str(tmp_path), "test", "zip")
+
+    assert os.listdir(str(tmp_path)) == []
+
+
+class TruncatingHandler(ObjectHandler):
+    # answers the first request for the first segment with a short body
+    def do_GET(self):
+        if (self.headers.get("Range") or "").startswith("bytes=0-") and not getattr(
+            self.server, "truncated", False
+        ):
+            self.server.truncated = True
+            self.server.requests.append(("GET", self.path, self.headers.get("Range")))
+            data = self.server.objects[self.path]
+            etag = '"%s"' % hashlib.md5(data).hexdigest()
+            headers = {"Content-Range": "bytes 0-16383/%d" % len(data), "ETag": etag}
+            self._respond(206, headers, data[:1000])
+            return
+        super(TruncatingHandler, self).do_GET()
+
+
+def test_download_errors(tmp_path):
+    path = str(tmp_path / "test.bin")
+
+    with serve({}, handler=ForbiddenHandler) as (server, url):
+        with pytest.raises(DownloadError):
+            download(url + "/test.bin", path)
+    assert not exists(path)
+
+    data = os.urandom(100000)
+    with serve({"/test.bin": data}, handler=TruncatingHandler) as (server, url):
+        download(url + "/test.bin", path, segment_size=16384)
+        assert len(server.requests) == 8
+
+    with open(path, "rb") as f:
+        assert f.read() == data
+
+
+class KmsHandler(ObjectHandler):
+    # etags of kms encrypted objects are not the md5 of the content
+    def send_header(self, keyword, value):
+        if keyword == "ETag":
+            super(KmsHandler, self).send_header(
+                "x-amz-server-side-encryption", "aws:kms"
+            )
+            value = '"%s"' % ("0" * 32)
+        super(KmsHandler, self).send_header(keyword, value)
+
+
+class SegmentFailingHandler(ObjectHandler):
+    # fails the segments after the first three
+    def do_GET(self):
+        m = re.match(r"bytes=(\d+)-", self.headers.get("Range") or "")
+        if m and int(m.group(1)) >= 3 * 16384:
+            self.server.requests.append(("GET", self.path, self.headers.get("Range")))
+            self._respond(500)
+            return
+        super(SegmentFailingHandler, self).do_GET()
+
+
+def test_resumed_unpack(monkeypatch, tmp_path, ztemp):
+    monkeypatch.setenv("KUDU_CACHE_DIR", str(tmp_path / "cache"))
+    mkdir(str(tmp_path / "out"))
+    monkeypatch.chdir(tmp_path / "out")
+    monkeypatch.setattr(
+        pull_module, "download", functools.partial(download, segment_size=16384)
+    )
+
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "index.html").write_bytes(os.urandom(100000))
+    _, name = ztemp("test", root_dir=str(src))
+    with open(name, "rb") as f:
+        objects = {"/test.zip": f.read()}
+
+    download_path = str(tmp_path / "test.bin")
+    with serve(objects, handler=KmsHandler) as (server, url):
+        download(url + "/test.zip", download_path, segment_size=16384)
+    with open(download_path, "rb") as f:
+        assert f.read() == objects["/test.zip"]
+
+    mkdir(str(tmp_path / "tmp"))
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path / "tmp"))
+    defaults = dict(api.http_options)
+    api.configure(retries=0)
+    try:
+        with serve(objects, handler=SegmentFailingHandler) as (server, url):
+            # without a cache key nothing is left behind for a resume
+            with pytest.raises(DownloadError):
+                unpack_url(url + "/test.zip", key=None)
+            assert os.listdir(str(tmp_path / "tmp")) == []
+
+            with pytest.raises(DownloadError):
+                unpack_url(url + "/test.zip", key="test.zip")
+        partial = archivecache.partial_path("test.zip")
+        assert exists(partial)
+
+        with serve(objects) as (server, url):
+            unpack_url(url + "/test.zip", key="test.zip")
+            # only the probe and the missing segments are fetched
+            segments = -(-len(objects["/test.zip"]) // 16384)
+            assert len(server.requests) == 1 + segments - 3
+        assert not exists(partial)
+    finally:
+        api.configure(**defaults)
+    assert os.listdir(str(tmp_path / "out")) == ["index.html"]
+    assert archivecache.lookup("test.zip")
@@ -1,12 +1,52 @@
+import io
+import os
+import shutil
+import tempfile
+import time
 import zipfile
 from os import mkdir
+from os.path import exists, join
 
+import click
+import pytest
 from click.testing import CliRunner
 
+from kudu import api
+from kudu import mkztemp as mkztemp_module
 from kudu.__main__ import cli
-from kudu.commands.push import CATEGORY_RULES
+from kudu import buildcache
+from kudu.buildcache import BuildCache, build_cache_dir
+from kudu.commands import push as push_module
+from kudu.commands.push import (
+    CATEGORY_RULES,
+    Stages,
+    get_compression_policy,
+    get_file_manifest,
+    get_metadata_with_github_info,
+    needs_content_length,
+    presigned_expiry,
+    upload_file_data,
+)
 from kudu.config import write_config
-from kudu.mkztemp import mkztemp
+from kudu.manifest import (
+    MANIFEST_DIGEST_KEY,
+    MANIFEST_KEY,
+    diff_manifest,
+    load_manifest,
+    manifest_digest,
+    save_manifest,
+)
+from kudu.mkztemp import (
+    CompressionPolicy,
+    PackageSummary,
+    mkzspool,
+    mkzstream,
+    mkztemp,
+)
+from kudu.namerules import NameMapper, NameRule, RuleConflict
+from kudu.progress import Progress
+from kudu.tests.httpserver import serve
+from kudu.upload import buffer_view, upload
 
 
 def test_interface():
@@ -23,7 +63,7 @@ def test_interface():
         assert result.exit_code == 0
 
 
-def test_rules():
+def test_rules(ztemp):
     runner = CliRunner()
 
     with runner.isolated_filesystem():
@@ -31,7 +71,7 @@ def test_rules():
         open("interface/index.html", "a").close()
 
         rules = [r.rule for r in CATEGORY_RULES if "" in r.category]
-        _, name = mkztemp("interface_test", name_rules=rules)
+        _, name = ztemp("interface_test", name_rules=rules)
 
         zf = zipfile.ZipFile(name)
         namelist = zf.namelist()
@@ -42,7 +82,7 @@ def test_rules():
         open("thumbnail.png", "a").close()
 
         rules = [r.rule for r in CATEGORY_RULES if "zip" in r.category]
-        _, name = mkztemp("test", name_rules=rules)
+        _, name = ztemp("test", name_rules=rules)
 
         zf = zipfile.ZipFile(name)
         namelist = zf.namelist()
@@ -51,6 +91,24 @@ def test_rules():
         assert "test/index.html" in namelist
 
 
+def test_name_rule_engine():
+    rules = [r.rule for r in CATEGORY_RULES if "zip" in r.category]
+    mapper = NameMapper(rules, "test")
+
+    # first match wins, the rewritten thumbnail is not matched again
+    assert mapper.map("thumbnail.png") == join("test", "test.png")
+    assert mapper.map(join("css", "thumbnail.png")) == join(
+        "test", "css", "thumbnail.png"
+    )
+    assert mapper.map("index.html") == join("test", "index.html")
+
+    with pytest.raises(RuleConflict):
+        NameMapper(rules[::-1], "test")
+
+    with pytest.raises(RuleConflict):
+        NameMapper([NameRule(r"^a", "b"), NameRule(r"^a", "c")], "test")
+
+
 def test_zip():
     runner = CliRunner()
     with runner.isolated_filesystem():
@@ -66,3 +124,472 @@ def test_json():
         open("upload.json", "a").close()
         result = runner.invoke(cli, ["push", "-f", 703251, "-p", "upload.json"])
         assert result.exit_code == 0
+
+
+def test_stream():
+    runner = CliRunner()
+
+    with runner.isolated_filesystem():
+        open("index.html", "a").close()
+        open("thumbnail.png", "a").close()
+        with open("slide.html", "w") as f:
+            f.write("<html></html>" * 1000)
+
+        rules = [r.rule for r in CATEGORY_RULES if "zip" in r.category]
+        data = b"".join(mkzstream("test", name_rules=rules))
+
+        zf = zipfile.ZipFile(io.BytesIO(data))
+        assert zf.testzip() is None
+        assert sorted(zf.namelist()) == [
+            "test/index.html",
+            "test/slide.html",
+            "test/test.png",
+        ]
+        assert zf.read("test/slide.html") == b"<html></html>" * 1000
+
+
+def test_needs_content_length():
+    assert needs_content_length(
+        "https://bucket.s3.amazonaws.com/1.zip?X-Amz-Expires=3600&X-Amz-Signature=ab"
+    )
+    assert not needs_content_length("https://upload.example.com/1.zip")
+
+
+def test_parallel(ztemp):
+    runner = CliRunner()
+
+    with runner.isolated_filesystem():
+        mkdir("slides")
+        open("thumbnail.png", "a").close()
+        for i in range(20):
+            with open("slides/%d.html" % i, "w") as f:
+                f.write("<p>%d</p>" % i * (i * 500))
+
+        rules = [r.rule for r in CATEGORY_RULES if "zip" in r.category]
+        _, sequential = ztemp("test", name_rules=rules)
+        _, parallel = ztemp("test", name_rules=rules, jobs=4)
+
+        with open(sequential, "rb") as a, open(parallel, "rb") as b:
+            assert a.read() == b.read()
+
+        zf = zipfile.ZipFile(parallel)
+        assert zf.testzip() is None
+        assert "test/test.png" in zf.namelist()
+        assert len(zf.namelist()) == 21
+
+        streamed = b"".join(mkzstream("test", name_rules=rules, jobs=4))
+        zf = zipfile.ZipFile(io.BytesIO(streamed))
+        assert zf.testzip() is None
+        assert zf.read("test/slides/19.html") == b"<p>19</p>" * 9500
+
+
+def test_manifest(monkeypatch, tmp_path):
+    monkeypatch.setenv("KUDU_CACHE_DIR", str(tmp_path))
+    runner = CliRunner()
+
+    with runner.isolated_filesystem():
+        open("index.html", "a").close()
+        open("thumbnail.png", "a").close()
+
+        manifest = get_file_manifest(None, "test", "zip")
+        assert sorted(manifest) == ["test/index.html", "test/test.png"]
+
+        metadata = {MANIFEST_DIGEST_KEY: manifest_digest(manifest)}
+        assert manifest_digest(get_file_manifest(None, "test", "zip")) == (
+            metadata[MANIFEST_DIGEST_KEY]
+        )
+        assert load_manifest(metadata[MANIFEST_DIGEST_KEY]) is None
+        save_manifest(manifest)
+        assert load_manifest(metadata[MANIFEST_DIGEST_KEY]) == manifest
+
+        with open("index.html", "w") as f:
+            f.write("<html></html>")
+        open("slide.html", "a").close()
+        os.remove("thumbnail.png")
+
+        changed = get_file_manifest(None, "test", "zip")
+        assert manifest_digest(changed) != metadata[MANIFEST_DIGEST_KEY]
+        remote = load_manifest(metadata[MANIFEST_DIGEST_KEY])
+        assert diff_manifest(remote, changed) == (
+            ["test/slide.html"],
+            ["test/test.png"],
+            ["test/index.html"],
+        )
+
+        # only the digest goes into the file record
+        monkeypatch.setattr(
+            push_module,
+            "get_file",
+            lambda file_id, token: {"metadata": {MANIFEST_KEY: {"a": "b"}}},
+        )
+        ctx = click.Context(click.Command("push"), obj={"token": None})
+        metadata = get_metadata_with_github_info(ctx, 1, changed)
+        assert MANIFEST_KEY not in metadata
+        assert metadata[MANIFEST_DIGEST_KEY] == manifest_digest(changed)
+        assert load_manifest(manifest_digest(changed)) == changed
+
+
+def test_compression_policy(monkeypatch, ztemp):
+    runner = CliRunner()
+
+    with runner.isolated_filesystem():
+        with open("index.html", "w") as f:
+            f.write("<html></html>" * 100)
+        with open("thumbnail.png", "wb") as f:
+            f.write(b"\x89PNG" * 100)
+        with open("video.bin", "wb") as f:
+            f.write(os.urandom(10000))
+
+        summary = PackageSummary()
+        _, name = ztemp("test", policy=CompressionPolicy(), summary=summary)
+
+        zf = zipfile.ZipFile(name)
+        assert zf.testzip() is None
+        assert zf.getinfo("index.html").compress_type == zipfile.ZIP_DEFLATED
+        assert zf.getinfo("thumbnail.png").compress_type == zipfile.ZIP_STORED
+        assert zf.getinfo("video.bin").compress_type == zipfile.ZIP_STORED
+        assert summary.stored[0] == 2
+        assert summary.deflated[0] == 1
+
+        policy = CompressionPolicy(store=[], deflate=[".bin"], level=9)
+        _, name = ztemp("test", policy=policy, jobs=2)
+
+        zf = zipfile.ZipFile(name)
+        assert zf.testzip() is None
+        assert zf.getinfo("thumbnail.png").compress_type == zipfile.ZIP_DEFLATED
+        assert zf.getinfo("video.bin").compress_type == zipfile.ZIP_DEFLATED
+
+    monkeypatch.setattr(push_module, "default_compression", lambda: {"level": 1})
+    assert get_compression_policy().level == 1
+    monkeypatch.setattr(push_module, "default_compression", lambda: {"levle": 1})
+    with pytest.raises(click.UsageError, match="levle"):
+        get_compression_policy()
+
+
+@pytest.mark.parametrize("raw_writes", [True, False])
+def test_precompressed_members(monkeypatch, raw_writes, ztemp):
+    if not raw_writes:
+        monkeypatch.setattr(mkztemp_module, "_raw_writes", lambda zf: False)
+    runner = CliRunner()
+
+    with runner.isolated_filesystem():
+        with open("index.html", "w") as f:
+            f.write("<html></html>" * 1000)
+        with open("thumbnail.png", "wb") as f:
+            f.write(os.urandom(10000))
+
+        _, name = ztemp("test", jobs=2)
+        streamed = b"".join(mkzstream("test"))
+
+        for zf in (zipfile.ZipFile(name), zipfile.ZipFile(io.BytesIO(streamed))):
+            assert zf.testzip() is None
+            assert zf.getinfo("index.html").compress_type == zipfile.ZIP_DEFLATED
+            assert zf.getinfo("thumbnail.png").compress_type == zipfile.ZIP_STORED
+            assert zf.read("index.html") == b"<html></html>" * 1000
+
+
+def test_build_cache(monkeypatch, tmp_path, ztemp):
+    monkeypatch.setenv("KUDU_CACHE_DIR", str(tmp_path))
+    runner = CliRunner()
+
+    with runner.isolated_filesystem():
+        mkdir("slides")
+        for i in range(10):
+            with open("slides/%d.html" % i, "w") as f:
+                f.write("<p>%d</p>" % i * 100)
+
+        _, first = ztemp("test", cache=BuildCache())
+        assert exists(join(build_cache_dir(os.curdir), "index.json"))
+        assert not exists(".kudu")
+
+        summary = PackageSummary()
+        _, second = ztemp("test", cache=BuildCache(), summary=summary, jobs=2)
+        assert summary.reused == 10
+
+        with open(first, "rb") as a, open(second, "rb") as b:
+            assert a.read() == b.read()
+
+        with open("slides/3.html", "w") as f:
+            f.write("<p>changed</p>")
+
+        summary = PackageSummary()
+        _, third = ztemp("test", cache=BuildCache(), summary=summary)
+        assert summary.reused == 9
+
+        zf = zipfile.ZipFile(third)
+        assert zf.testzip() is None
+        assert ".kudu/cache/index.json" not in zf.namelist()
+        assert zf.read("slides/3.html") == b"<p>changed</p>"
+        assert zf.getinfo("slides/3.html").date_time == (1980, 1, 1, 0, 0, 0)
+
+        # stored members are not copied into the cache
+        with open("video.mp4", "wb") as f:
+            f.write(os.urandom(10000))
+        summary = PackageSummary()
+        ztemp("test", policy=CompressionPolicy(), cache=BuildCache(), summary=summary)
+        assert summary.reused == summary.deflated[0] == 9
+        objects = join(build_cache_dir(os.curdir), "objects")
+        assert sum(len(files) for _, _, files in os.walk(objects)) == 9
+
+        # builds of other roots are pruned first once the cache is too large
+        mkdir("other")
+        shutil.copy("slides/1.html", "other")
+        BuildCache("other").save()
+        os.utime(build_cache_dir(os.curdir), (0, 0))
+        buildcache.prune(0, keep=build_cache_dir("other"))
+        assert exists(build_cache_dir("other"))
+        assert not exists(build_cache_dir(os.curdir))
+
+
+def test_multipart_upload(monkeypatch, tmp_path):
+    monkeypatch.setenv("KUDU_CACHE_DIR", str(tmp_path))
+    defaults = dict(api.http_options)
+    api.configure(retries=0)
+
+    data = os.urandom(100000)
+    part_size = 16384
+
+    try:
+        with serve({}) as (server, url):
+
+            def get_target(parts, name="1.zip"):
+                return {
+                    "parts": ["%s/%s/%d" % (url, name, n) for n in range(1, parts + 1)],
+                    "complete": "%s/%s" % (url, name),
+                }
+
+            with open(tmp_path / "1.zip", "w+b") as f:
+                f.write(data)
+                f.seek(0)
+
+                server.failing.add("/1.zip/3")
+                with pytest.raises(IOError):
+                    upload(f, get_target, part_size, connections=2)
+                assert "/1.zip" not in server.objects
+
+                # resumes with the parts that made it
+                server.failing.clear()
+                del server.requests[:]
+                progress = Progress("Uploading", size=len(data))
+                res = upload(f, get_target, part_size, 2, progress)
+                assert res.status_code == 200
+                assert progress.size == len(data)
+                assert server.objects["/1.zip"] == data
+                assert len(server.requests) < 7
+
+                # single presigned url
+                progress = Progress("Uploading", size=len(data))
+                res = upload(f, lambda parts: url + "/2.zip", part_size, 1, progress)
+                assert res.status_code == 200
+                assert server.objects["/2.zip"] == data
+                assert progress.size == len(data)
+
+                # checkpoints of one file never resume the upload to another
+                server.failing.add("/3.zip/3")
+                with pytest.raises(IOError):
+                    upload(
+                        f, lambda parts: get_target(parts, "3.zip"), part_size, key=3
+                    )
+                server.failing.clear()
+                res = upload(
+                    f, lambda parts: get_target(parts, "4.zip"), part_size, key=4
+                )
+                assert res.status_code == 200
+                assert server.objects["/4.zip"] == data
+                assert "/3.zip" not in server.objects
+    finally:
+        api.configure(**defaults)
+
+
+def test_progress_rate_limit(capsys):
+    with Progress("Packaging", files=1000, interval=60) as progress:
+        for _ in range(1000):
+            progress.update(1, 1024)
+
+    # logs only get the summary when the work is faster than the interval
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 1
+    assert lines[0].startswith("Packaging: 1000 files, 1000.0 KB in ")
+    assert lines[0].endswith(", done.")
+
+    progress = Progress("Packaging", files=4, size=4096, interval=0)
+    progress.update(1, 1024)
+    line = capsys.readouterr().out.strip()
+    assert line.startswith("Packaging: 1/4 files, 1.0 KB/4.0 KB, ")
+    assert "ETA" in line
+
+
+class _Json:
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+def test_upload_pipeline(monkeypatch, tmp_path):
+    monkeypatch.setenv("KUDU_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(push_module, "get_file", lambda file_id, token: {})
+
+    assert presigned_expiry("https://s3/1.zip?Expires=1600000000") == 1600000000
+    assert (
+        presigned_expiry(
+            "https://s3/1.zip?X-Amz-Date=20200913T122640Z&X-Amz-Expires=60"
+        )
+        == 1600000060
+    )
+    assert presigned_expiry("https://s3/1.zip") is None
+
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "index.html").write_bytes(b"<p>kudu</p>" * 10000)
+    (src / "video.mp4").write_bytes(os.urandom(50000))
+
+    with serve({}) as (server, url):
+        fetched = []
+        expires = [int(time.time()) + 3600]
+
+        def api_request(method, path, token=None, params=None):
+            parts = (params or {}).get("parts")
+            fetched.append(parts)
+            query = "?Expires=%d" % expires[0]
+            if not parts:
+                return _Json(url + "/1.zip" + query)
+            return _Json(
+                {
+                    "parts": [
+                        "%s/1.zip/%d%s" % (url, n, query) for n in range(1, parts + 1)
+                    ],
+                    "complete": url + "/1.zip" + query,
+                }
+            )
+
+        monkeypatch.setattr(push_module, "api_request", api_request)
+
+        # fetched while packaging for the largest possible archive
+        stages = Stages()
+        res = upload_file_data(
+            None, 1, str(src), "kudu", "zip", part_size=65536, stages=stages
+        )
+        assert res.status_code == 200
+        assert fetched == [3]
+        assert zipfile.ZipFile(io.BytesIO(server.objects["/1.zip"])).testzip() is None
+        assert set(stages.seconds) == {"upload url", "package", "upload"}
+        assert str(stages).startswith("Stages: ")
+
+        # fetched again when it expires before the upload starts
+        del fetched[:]
+        expires[0] = int(time.time()) + 10
+        res = upload_file_data(None, 1, str(src / "video.mp4"), "kudu", "zip")
+        assert res.status_code == 200
+        assert fetched == [None, None]
+        assert server.objects["/1.zip"] == (src / "video.mp4").read_bytes()
+
+        # servers that ignore parts hand out a single url that is used as is
+        del fetched[:]
+        expires[0] = int(time.time()) + 3600
+        monkeypatch.setattr(
+            push_module,
+            "api_request",
+            lambda method, path, token=None, params=None: (
+                fetched.append((params or {}).get("parts"))
+                or _Json(url + "/2.zip?Expires=%d" % expires[0])
+            ),
+        )
+        res = upload_file_data(None, 1, str(src), "kudu", "zip", part_size=16384)
+        assert res.status_code == 200
+        assert len(fetched) == 1 and fetched[0] > 1
+
+        # a presigned url fetched for streaming is not fetched again
+        del fetched[:]
+        monkeypatch.setattr(
+            push_module,
+            "api_request",
+            lambda method, path, token=None, params=None: (
+                fetched.append((params or {}).get("parts"))
+                or _Json(url + "/3.zip?X-Amz-Signature=x")
+            ),
+        )
+        res = upload_file_data(None, 1, str(src), "kudu", "zip", stream=True)
+        assert res.status_code == 200
+        assert fetched == [None]
+        assert zipfile.ZipFile(io.BytesIO(server.objects["/3.zip"])).testzip() is None
+        assert zipfile.ZipFile(io.BytesIO(server.objects["/2.zip"])).testzip() is None
+
+
+class _Interrupt:
+    def update(self, files=0, size=0):
+        raise KeyboardInterrupt
+
+
+def test_spooled_package(monkeypatch, tmp_path):
+    monkeypatch.setenv("KUDU_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    defaults = dict(api.http_options)
+    api.configure(retries=0)
+
+    src = tmp_path / "src"
+    src.mkdir()
+    for i in range(4):
+        (src / ("%d.bin" % i)).write_bytes(os.urandom(20000))
+
+    try:
+        with serve({}) as (server, url):
+
+            def get_target(parts):
+                if not parts:
+                    return url + "/1.zip"
+                return {
+                    "parts": ["%s/1.zip/%d" % (url, n) for n in range(1, parts + 1)],
+                    "complete": url + "/1.zip",
+                }
+
+            # small archives stay in memory, larger ones spill to an unnamed file
+            for max_size, rolled in ((1 << 20, False), (16384, True), (0, True)):
+                with mkzspool("test", root_dir=str(src), max_size=max_size) as spool:
+                    assert spool.rolled == rolled
+
+                    with buffer_view(spool) as view:
+                        data = bytes(view)
+                    assert spool.seek(0) == 0 and spool.read() == data
+                    # uploading never moves an in-memory archive to disk
+                    assert spool.rolled == rolled
+                    assert zipfile.ZipFile(io.BytesIO(data)).testzip() is None
+
+                    for part_size in (0, 16384):
+                        res = upload(spool, get_target, part_size, connections=2)
+                        assert res.status_code == 200
+                        assert server.objects["/1.zip"] == data
+
+            # interrupted packaging removes its temp files too
+            for package in (mkzspool, mkztemp):
+                with pytest.raises(KeyboardInterrupt):
+                    package("test", root_dir=str(src), progress=_Interrupt())
+    finally:
+        api.configure(**defaults)
+
+    # nothing is left behind in the temp directory
+    assert sorted(os.listdir(str(tmp_path))) == ["cache", "src"]
+
+
+def test_failed_upload(monkeypatch, tmp_path):
+    monkeypatch.setattr(push_module, "get_file", lambda file_id, token: {})
+    defaults = dict(api.http_options)
+    api.configure(retries=0)
+
+    (tmp_path / "index.html").write_bytes(b"<p>kudu</p>")
+
+    try:
+        with serve({}) as (server, url):
+            monkeypatch.setattr(
+                push_module,
+                "api_request",
+                lambda method, path, token=None, params=None: _Json(url + "/1.zip"),
+            )
+            server.failing.add("/1.zip")
+
+            with pytest.raises(click.ClickException) as e:
+                upload_file_data(None, 1, str(tmp_path), "kudu", "zip")
+            assert "status 500" in e.value.format_message()
+    finally:
+        api.configure(**defaults)
@@ -0,0 +1,64 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+_events = None
+_path = None
+_origin = 0.0
+_lock = threading.Lock()
+
+
+def start(path):
+    global _events, _path, _origin
+
+    _events = []
+    _path = path
+    _origin = time.perf_counter()
+
+
+def enabled():
+    return _events is not None
+
+
+def _now():
+    return (time.perf_counter() - _origin) * 1e6
+
+
+@contextmanager
+def span(name, **args):
+    # callers add bytes, file counts or http status to args while it runs
+    if _events is None:
+        yield args
+        return
+
+    begin = _now()
+    try:
+        yield args
+    finally:
+        event = {
+            "name": name,
+            "cat": "kudu",
+            "ph": "X",
+            "ts": round(begin, 1),
+            "dur": round(_now() - begin, 1),
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": args,
+        }
+        with _lock:
+            _events.append(event)
+
+
+def save():
+    global _events
+
+    if _events is None:
+        return
+
+    with _lock:
+        events, _events = _events, None
+
+    with open(_path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
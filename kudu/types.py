@@ -1,6 +1,9 @@
+import click
+from click.core import ParameterSource
 from click.types import IntParamType
 
-from kudu.api import request as api_request
+from kudu import trace
+from kudu.api import get_file
 
 
 class PitcherFileType(IntParamType):
@@ -15,12 +18,22 @@ class PitcherFileType(IntParamType):
 
         value = super(PitcherFileType, self).convert(value, param, ctx)
 
-        res = api_request("get", "/files/%d/" % value, token=ctx.obj["token"])
-        if res.status_code != 200:
+        with trace.span("file lookup", file_id=value):
+            data = get_file(value, token=ctx.obj["token"])
+        if data is None:
             self.fail("%d is not a valid file" % value)
 
-        data = res.json()
         if self.category and data.get("category") not in self.category:
             self.fail("%d is not of a valid file category" % value)
 
         return data
+
+
+def prompt_option(ctx, name, **kwargs):
+    # prompt=True of an option, for prompts that depend on the subcommand
+    if ctx.get_parameter_source(name) in (
+        ParameterSource.COMMANDLINE,
+        ParameterSource.ENVIRONMENT,
+    ):
+        return ctx.params[name]
+    return click.prompt(name.capitalize(), default=ctx.params[name], **kwargs)
@@ -0,0 +1,213 @@
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from xml.sax.saxutils import escape
+
+from kudu.api import send
+from kudu.config import cache_dir
+
+PART_SIZE = 64 << 20
+CHUNK_SIZE = 1 << 20
+RETRIES = 3
+
+
+class UploadError(IOError):
+    pass
+
+
+class UploadCheckpoint:
+    def __init__(self, digest, part_size):
+        self.path = cache_dir("uploads", digest + ".json")
+        self.part_size = part_size
+        self.target = None
+        self.etags = {}
+        self.lock = threading.Lock()
+
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return
+
+        if data.get("part_size") == part_size:
+            self.target = data.get("target")
+            self.etags = {int(n): etag for n, etag in data.get("etags", {}).items()}
+
+    def save(self, target, part_number=None, etag=None):
+        with self.lock:
+            self.target = target
+            if part_number is not None:
+                self.etags[part_number] = etag
+
+            data = {"part_size": self.part_size, "target": target, "etags": self.etags}
+
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path))
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def file_size(fp):
+    # in-memory spools have no fileno()
+    fp.seek(0, os.SEEK_END)
+    size = fp.tell()
+    fp.seek(0)
+    return size
+
+
+@contextmanager
+def buffer_view(fp):
+    # zero copy view of an in-memory archive or of the mapped file
+    mapped = None
+    view = fp.getbuffer() if hasattr(fp, "getbuffer") else None
+    if view is None and file_size(fp):
+        mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapped)
+    elif view is None:
+        # empty files cannot be mapped
+        view = memoryview(b"")
+
+    try:
+        yield view
+    finally:
+        # the spool and the map can only be closed once the view is released
+        view.release()
+        if mapped is not None:
+            mapped.close()
+
+
+class _ProgressView:
+    # sent with a Content-Length in chunks that count towards progress
+    def __init__(self, view, progress):
+        self.view = view
+        self.progress = progress
+
+    def __len__(self):
+        return len(self.view)
+
+    def __iter__(self):
+        for offset in range(0, len(self.view), CHUNK_SIZE):
+            with self.view[offset : offset + CHUNK_SIZE] as chunk:
+                yield chunk
+                self.progress.update(size=len(chunk))
+
+
+def _put_file(url, view, progress=None):
+    if progress is not None:
+        return send("put", url, data=_ProgressView(view, progress))
+    return send("put", url, data=view)
+
+
+def is_multipart(target):
+    return isinstance(target, dict) and "parts" in target and "complete" in target
+
+
+def _put_part(url, data):
+    for attempt in range(RETRIES):
+        try:
+            res = send("put", url, data=data)
+            if res.status_code == 200 and res.headers.get("ETag"):
+                return res.headers["ETag"]
+            raise UploadError("Part upload failed with status %d" % res.status_code)
+        except (IOError, OSError):
+            if attempt == RETRIES - 1:
+                raise
+
+
+def _complete_body(etags):
+    parts = "".join(
+        "<Part><PartNumber>%d</PartNumber><ETag>%s</ETag></Part>"
+        % (number, escape(etags[number]))
+        for number in sorted(etags)
+    )
+    return "<CompleteMultipartUpload>%s</CompleteMultipartUpload>" % parts
+
+
+def multipart_upload(
+    view, target, part_size, connections=4, checkpoint=None, progress=None
+):
+    size = len(view)
+    etags = dict(checkpoint.etags) if checkpoint else {}
+
+    if progress is not None:
+        # parts of an interrupted upload count as done
+        progress.update(
+            size=sum(min(part_size, size - (n - 1) * part_size) for n in etags)
+        )
+
+    if checkpoint:
+        checkpoint.save(target)
+
+    def upload_part(number, url):
+        offset = (number - 1) * part_size
+        with view[offset : offset + part_size] as data:
+            etags[number] = _put_part(url, data)
+            if checkpoint:
+                checkpoint.save(target, number, etags[number])
+            if progress is not None:
+                progress.update(size=len(data))
+
+    with ThreadPoolExecutor(max(1, connections)) as executor:
+        futures = [
+            executor.submit(upload_part, number, url)
+            for number, url in enumerate(target["parts"], 1)
+            if number not in etags and (number - 1) * part_size < size
+        ]
+        for future in futures:
+            future.result()
+
+    res = send("post", target["complete"], data=_complete_body(etags))
+    if res.status_code == 200 and checkpoint:
+        checkpoint.remove()
+
+    return res
+
+
+def upload(fp, get_target, part_size=PART_SIZE, connections=4, progress=None, key=None):
+    with buffer_view(fp) as view:
+        return _upload(view, get_target, part_size, connections, progress, key)
+
+
+def _upload(view, get_target, part_size, connections, progress, key=None):
+    size = len(view)
+
+    if not part_size or size <= part_size:
+        target = get_target(None)
+        # targets fetched before the archive was built may expect parts
+        if is_multipart(target):
+            return multipart_upload(view, target, max(1, size), 1, None, progress)
+        return _put_file(target, view, progress)
+
+    digest = hashlib.sha256(view).hexdigest()
+    if key is not None:
+        # the same content uploaded to another file is another upload
+        digest = "%s-%s" % (key, digest)
+    checkpoint = UploadCheckpoint(digest, part_size)
+
+    if is_multipart(checkpoint.target):
+        try:
+            return multipart_upload(
+                view, checkpoint.target, part_size, connections, checkpoint, progress
+            )
+        except UploadError:
+            # part urls of the interrupted upload most likely expired
+            checkpoint.remove()
+            checkpoint = UploadCheckpoint(digest, part_size)
+
+    target = get_target(-(-size // part_size))
+
+    # the server only issued a single presigned url
+    if not is_multipart(target):
+        return _put_file(target, view, progress)
+
+    return multipart_upload(view, target, part_size, connections, checkpoint, progress)
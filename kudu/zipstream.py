@@ -0,0 +1,178 @@
+import os
+import struct
+import zipfile
+import zlib
+
+CHUNK_SIZE = 1 << 20
+
+LOCAL_FILE_HEADER = struct.Struct("<4s5H3L2H")
+LOCAL_FILE_SIGNATURE = b"PK\x03\x04"
+DATA_DESCRIPTOR_SIGNATURE = b"PK\x07\x08"
+END_OF_CENTRAL_DIRECTORY_SIGNATURE = b"PK\x05\x06"
+
+FLAG_ENCRYPTED = 0x01
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+
+class UnsupportedZipStream(Exception):
+    pass
+
+
+class _StreamReader:
+    def __init__(self, fp):
+        self.fp = fp
+        self.buffer = b""
+
+    def read(self, size):
+        if self.buffer:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+            return data
+        return self.fp.read(size)
+
+    def read_exactly(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self.read(size - len(data))
+            if not chunk:
+                raise zipfile.BadZipFile("Unexpected end of zip stream")
+            data += chunk
+        return data
+
+    def unread(self, data):
+        self.buffer = data + self.buffer
+
+
+def _zip64_sizes(extra, file_size, compress_size):
+    while len(extra) >= 4:
+        tag, size = struct.unpack("<HH", extra[:4])
+        if tag == 0x0001:
+            values = extra[4 : 4 + size]
+            if file_size == 0xFFFFFFFF:
+                (file_size,) = struct.unpack("<Q", values[:8])
+                values = values[8:]
+            if compress_size == 0xFFFFFFFF:
+                (compress_size,) = struct.unpack("<Q", values[:8])
+            return file_size, compress_size, True
+        extra = extra[4 + size :]
+    return file_size, compress_size, False
+
+
+def _read_stored(reader, size):
+    while size:
+        chunk = reader.read(min(size, CHUNK_SIZE))
+        if not chunk:
+            raise zipfile.BadZipFile("Unexpected end of zip stream")
+        size -= len(chunk)
+        yield chunk
+
+
+def _read_deflated(reader, compress_size=None):
+    decompressor = zlib.decompressobj(-15)
+    remaining = compress_size
+
+    while not decompressor.eof:
+        size = CHUNK_SIZE if remaining is None else min(remaining, CHUNK_SIZE)
+        chunk = reader.read(size) if size else b""
+        if not chunk:
+            raise zipfile.BadZipFile("Unexpected end of zip stream")
+        if remaining is not None:
+            remaining -= len(chunk)
+        yield decompressor.decompress(chunk)
+
+    if decompressor.unused_data:
+        reader.unread(decompressor.unused_data)
+
+
+def _read_data_descriptor(reader, zip64):
+    data = reader.read_exactly(4)
+    if data == DATA_DESCRIPTOR_SIGNATURE:
+        data = reader.read_exactly(4)
+    (crc,) = struct.unpack("<L", data)
+    reader.read_exactly(16 if zip64 else 8)
+    return crc
+
+
+def iter_members(fp):
+    reader = _StreamReader(fp)
+    first = True
+
+    while True:
+        signature = reader.read_exactly(4)
+        if signature != LOCAL_FILE_SIGNATURE:
+            # only an empty archive starts with its end record
+            if first and signature != END_OF_CENTRAL_DIRECTORY_SIGNATURE:
+                raise zipfile.BadZipFile("Not a zip stream")
+            # central directory, no more members
+            return
+        first = False
+
+        header = LOCAL_FILE_HEADER.unpack(signature + reader.read_exactly(26))
+        flags, method, crc = header[2], header[3], header[6]
+        compress_size, file_size = header[7], header[8]
+
+        name = reader.read_exactly(header[9])
+        extra = reader.read_exactly(header[10])
+
+        name = name.decode("utf-8" if flags & FLAG_UTF8 else "cp437")
+        file_size, compress_size, zip64 = _zip64_sizes(extra, file_size, compress_size)
+
+        if flags & FLAG_ENCRYPTED:
+            raise UnsupportedZipStream("Encrypted member %s" % name)
+
+        descriptor = flags & FLAG_DATA_DESCRIPTOR
+        if method == zipfile.ZIP_STORED and not descriptor:
+            chunks = _read_stored(reader, compress_size)
+        elif method == zipfile.ZIP_DEFLATED:
+            chunks = _read_deflated(reader, None if descriptor else compress_size)
+        else:
+            raise UnsupportedZipStream("Cannot stream member %s" % name)
+
+        yield name, _verified(reader, chunks, crc, descriptor, zip64)
+
+
+def _verified(reader, chunks, crc, descriptor, zip64):
+    actual = 0
+    for chunk in chunks:
+        actual = zlib.crc32(chunk, actual)
+        yield chunk
+
+    if descriptor:
+        crc = _read_data_descriptor(reader, zip64)
+
+    if actual != crc:
+        raise zipfile.BadZipFile("Bad CRC-32 in zip stream")
+
+
+def member_parts(name):
+    return [p for p in name.replace("\\", "/").split("/") if p not in ("", ".", "..")]
+
+
+def extract_stream(fp, root_dir, mapper=None, progress=None):
+    count = 0
+
+    for name, chunks in iter_members(fp):
+        parts = member_parts(name)
+        if mapper and parts:
+            parts = mapper(parts)
+
+        if not parts or name.endswith("/"):
+            # directories are created along with their files
+            for _ in chunks:
+                pass
+            continue
+
+        path = os.path.join(root_dir, *parts)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        size = 0
+        with open(path, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+                size += len(chunk)
+
+        count += 1
+        if progress is not None:
+            progress.update(1, size)
+
+    return count